@@ -0,0 +1,42 @@
+from fastapi import HTTPException, status
+from pydantic import BaseModel
+
+
+# Helpers for the routes that look up many records by id in one request,
+# like GET /api/clues?ids=1,2,3 or POST /api/clues/lookup
+
+# The most ids one request may ask for
+MAX_IDS = 1000
+
+
+class IdsIn(BaseModel):
+    ids: list[int]
+
+
+def parse_ids(ids):
+    # Turns "1,2,3" into [1, 2, 3]
+    try:
+        ids = [int(id) for id in ids.split(",") if id.strip()]
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="ids must be a comma separated list of numbers",
+        )
+    return check_ids(ids)
+
+
+def check_ids(ids):
+    if len(ids) > MAX_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Can't look up more than {MAX_IDS} ids at once",
+        )
+    return ids
+
+
+def in_request_order(ids, found):
+    # found maps id to record. Returns the records in the order of ids,
+    # with None where an id was not found, and the ids that were not found
+    records = [found.get(id) for id in ids]
+    not_found = [id for id in ids if id not in found]
+    return records, not_found
@@ -0,0 +1,185 @@
+# A made-up dataset shaped like the jservice data, for the benchmarks.
+#
+# The PostgreSQL tables go in their own schema so the real data is never
+# touched. Connections see them when the search_path starts with that
+# schema, which the benchmarks do with PGOPTIONS (see search_path_options).
+# The Mongo collections go in their own database.
+#
+# Ids are numbered from 1 with no gaps, so the benchmarks can pick random
+# ids without asking the database what exists.
+import random
+
+
+SCHEMA = "bench_suite"
+
+# Roughly the proportions of the real jservice data
+CLUES_PER_CATEGORY = 8
+CLUES_PER_GAME = 60
+
+# Words the questions and answers are made of, so full text search
+# has something to find
+WORDS = [
+    "river", "capital", "president", "novel", "planet", "opera",
+    "island", "element", "painter", "mountain", "olympic", "symphony",
+    "empire", "desert", "poet", "bridge", "volcano", "treaty",
+    "galaxy", "cathedral",
+]
+
+MONGO_BATCH = 10000
+
+
+class Sizes:
+    def __init__(self, num_clues):
+        self.clues = num_clues
+        self.categories = max(num_clues // CLUES_PER_CATEGORY, 1)
+        self.games = max(num_clues // CLUES_PER_GAME, 1)
+        # categories without clues, for the DELETE /api/categories route
+        self.spare_categories = max(self.categories // 10, 10)
+
+    def as_dict(self):
+        return {
+            "clues": self.clues,
+            "categories": self.categories,
+            "games": self.games,
+            "spare_categories": self.spare_categories,
+        }
+
+
+def search_path_options(schema=SCHEMA):
+    # public stays on the path for extensions like pg_trgm
+    return f"-c search_path={schema},public"
+
+
+def seed_postgres(conn, sizes, schema=SCHEMA):
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        cur.execute(f"CREATE SCHEMA {schema}")
+        cur.execute(f"SET search_path TO {schema}, public")
+        cur.execute(
+            """
+            CREATE TABLE categories (
+                id SERIAL PRIMARY KEY,
+                title TEXT NOT NULL,
+                canon BOOLEAN NOT NULL
+            );
+
+            CREATE TABLE games (
+                id SERIAL PRIMARY KEY,
+                episode_id INTEGER NOT NULL,
+                aired TEXT NOT NULL,
+                canon BOOLEAN NOT NULL
+            );
+
+            CREATE TABLE clues (
+                id SERIAL PRIMARY KEY,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                value INTEGER,
+                invalid_count INTEGER NOT NULL DEFAULT 0,
+                canon BOOLEAN NOT NULL,
+                category_id INTEGER NOT NULL REFERENCES categories,
+                game_id INTEGER REFERENCES games
+            );
+
+            CREATE TABLE game_definitions (
+                id SERIAL PRIMARY KEY,
+                created_on TIMESTAMP NOT NULL
+            );
+
+            CREATE TABLE game_definition_clues (
+                id SERIAL PRIMARY KEY,
+                game_definition_id INTEGER NOT NULL
+                    REFERENCES game_definitions ON DELETE CASCADE,
+                clue_id INTEGER NOT NULL REFERENCES clues
+            );
+        """
+        )
+        cur.execute(
+            """
+            INSERT INTO categories (title, canon)
+            SELECT 'Category ' || n, n %% 10 <> 0
+            FROM generate_series(1, %s) AS n
+        """,
+            [sizes.categories],
+        )
+        cur.execute(
+            """
+            INSERT INTO categories (title, canon)
+            SELECT 'Spare category ' || n, false
+            FROM generate_series(1, %s) AS n
+        """,
+            [sizes.spare_categories],
+        )
+        cur.execute(
+            """
+            INSERT INTO games (episode_id, aired, canon)
+            SELECT n, (DATE '1984-09-10' + n)::text, true
+            FROM generate_series(1, %s) AS n
+        """,
+            [sizes.games],
+        )
+        # Five values per category like a real board, about 1 in 20 clues
+        # is invalid and 1 in 10 is not canon
+        cur.execute(
+            """
+            INSERT INTO clues (question, answer, value, invalid_count,
+                canon, category_id, game_id)
+            SELECT
+                'This ' || (%(words)s)[1 + n %% 20] || ' is famous for its '
+                    || (%(words)s)[1 + (n / 20) %% 20] || ' number ' || n,
+                'the ' || (%(words)s)[1 + (n / 400) %% 20] || ' ' || n,
+                200 * (1 + n %% 5),
+                CASE WHEN n %% 20 = 0 THEN 1 ELSE 0 END,
+                n %% 10 <> 0,
+                1 + (n / 5) %% %(categories)s,
+                1 + n %% %(games)s
+            FROM generate_series(1, %(clues)s) AS n
+        """,
+            {
+                "words": WORDS,
+                "categories": sizes.categories,
+                "games": sizes.games,
+                "clues": sizes.clues,
+            },
+        )
+        cur.execute("ANALYZE")
+    conn.commit()
+
+
+def drop_postgres(conn, schema=SCHEMA):
+    conn.rollback()
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+    conn.commit()
+
+
+def seed_mongo(db, sizes):
+    # The same categories, and clues with just what the category
+    # routes read from them
+    db.categories.drop()
+    db.clues.drop()
+    total = sizes.categories + sizes.spare_categories
+    for start in range(1, total + 1, MONGO_BATCH):
+        db.categories.insert_many([
+            {
+                "_id": n,
+                "title": f"Category {n}" if n <= sizes.categories
+                else f"Spare category {n - sizes.categories}",
+                "canon": n <= sizes.categories and n % 10 != 0,
+            }
+            for n in range(start, min(start + MONGO_BATCH, total + 1))
+        ], ordered=False)
+    for start in range(1, sizes.clues + 1, MONGO_BATCH):
+        db.clues.insert_many([
+            {"_id": n, "category_id": 1 + (n // 5) % sizes.categories}
+            for n in range(start, min(start + MONGO_BATCH, sizes.clues + 1))
+        ], ordered=False)
+
+
+def drop_mongo(client, dbname):
+    client.drop_database(dbname)
+
+
+def search_terms(count, seed=None):
+    rng = random.Random(seed)
+    return [" ".join(rng.sample(WORDS, 2)) for _ in range(count)]
@@ -0,0 +1,143 @@
+# Compares picking random clues with ORDER BY RANDOM() against the
+# in-memory sampler in sampler.py, at different numbers of clues.
+#
+# It creates its own tables in a separate "bench_random" schema of the
+# database given by the PG* environment variables and drops it at the end.
+#
+# Run from the api directory:
+#   python -m benchmarks.random_clue --sizes 100000 1000000
+import argparse
+import statistics
+import time
+import psycopg
+import sampler
+
+
+SCHEMA = "bench_random"
+
+
+def seed(conn, num_clues):
+    num_categories = max(num_clues // 50, 1)
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {SCHEMA}")
+        cur.execute(f"SET search_path TO {SCHEMA}")
+        cur.execute(
+            """
+            CREATE TABLE categories (
+                id SERIAL PRIMARY KEY,
+                title TEXT NOT NULL,
+                canon BOOLEAN NOT NULL
+            )
+        """
+        )
+        cur.execute(
+            """
+            CREATE TABLE clues (
+                id SERIAL PRIMARY KEY,
+                question TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                value INTEGER NOT NULL,
+                invalid_count INTEGER NOT NULL,
+                canon BOOLEAN NOT NULL,
+                category_id INTEGER NOT NULL REFERENCES categories
+            )
+        """
+        )
+        cur.execute(
+            """
+            INSERT INTO categories (title, canon)
+            SELECT 'Category ' || n, true
+            FROM generate_series(1, %s) AS n
+        """,
+            [num_categories],
+        )
+        # about 1 in 20 clues is invalid and 1 in 10 is not canon
+        cur.execute(
+            """
+            INSERT INTO clues (question, answer, value, invalid_count,
+                canon, category_id)
+            SELECT 'Question ' || n, 'Answer ' || n, 200 * (1 + n %% 5),
+                CASE WHEN n %% 20 = 0 THEN 1 ELSE 0 END,
+                n %% 10 <> 0,
+                1 + n %% %s
+            FROM generate_series(1, %s) AS n
+        """,
+            [num_categories, num_clues],
+        )
+        cur.execute("ANALYZE categories")
+        cur.execute("ANALYZE clues")
+    conn.commit()
+
+
+def order_by_random(conn, n):
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT {sampler.CLUE_COLUMNS}
+            FROM categories
+                INNER JOIN clues
+                ON (clues.category_id = categories.id)
+            WHERE clues.canon IS true
+            ORDER BY RANDOM() LIMIT %s
+        """,
+            [n],
+        )
+        return cur.fetchall()
+
+
+def timed(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {
+        "mean_ms": statistics.mean(times),
+        "p50_ms": times[len(times) // 2],
+        "p95_ms": times[int(len(times) * 0.95) - 1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    with psycopg.connect() as conn:
+        try:
+            for size in args.sizes:
+                seed(conn, size)
+                canon = sampler.ClueSampler("clues.canon IS true")
+                start = time.perf_counter()
+                canon.reload(conn)
+                load_ms = (time.perf_counter() - start) * 1000
+                print(f"{size} clues, sampler loaded in {load_ms:.0f} ms")
+                for n in (1, 30):
+                    results = {
+                        "ORDER BY RANDOM()": timed(
+                            lambda: order_by_random(conn, n), args.repeat
+                        ),
+                        "sampler": timed(
+                            lambda: canon.fetch(conn, n), args.repeat
+                        ),
+                    }
+                    for name, result in results.items():
+                        print(
+                            f"  {n:>2} clues  {name:<18}"
+                            f"  mean {result['mean_ms']:8.2f} ms"
+                            f"  p50 {result['p50_ms']:8.2f} ms"
+                            f"  p95 {result['p95_ms']:8.2f} ms"
+                        )
+                    conn.rollback()
+        finally:
+            conn.rollback()
+            with conn.cursor() as cur:
+                cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+            conn.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Times /api/clues/search queries against the real clues table (load the
+# full jservice data and run the migrations in schema.py first) and checks
+# that they stay under the target time.
+#
+# Run from the api directory:
+#   python -m benchmarks.search
+#   python -m benchmarks.search --target-ms 50 "state capitals" "-river nile"
+import argparse
+import sys
+import time
+import psycopg
+from routers.clues import clue_search_query
+
+
+TERMS = [
+    "president",
+    "shakespeare play",
+    "capital city",
+    "\"world war\"",
+    "river -nile",
+    "chemistry element",
+    "olympic gold",
+    "beatles or stones",
+]
+
+FUZZY_TERMS = ["missisippi", "shakespere", "einstien"]
+
+
+def time_query(conn, q, fuzzy, repeat):
+    sql, params = clue_search_query(q, fuzzy, None)
+    times = []
+    with conn.cursor() as cur:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+            times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return len(rows), times[len(times) // 2], times[int(len(times) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--target-ms", type=float, default=50)
+    parser.add_argument("terms", nargs="*")
+    args = parser.parse_args()
+
+    searches = [(term, False) for term in args.terms or TERMS]
+    if not args.terms:
+        searches += [(term, True) for term in FUZZY_TERMS]
+
+    slow = 0
+    with psycopg.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM clues")
+            print(f"{cur.fetchone()[0]} clues")
+        for term, fuzzy in searches:
+            found, p50, p95 = time_query(conn, term, fuzzy, args.repeat)
+            flag = ""
+            if p95 > args.target_ms:
+                flag = "  SLOW"
+                slow += 1
+            kind = "fuzzy" if fuzzy else "text"
+            print(
+                f"{kind:<6} {term!r:<24} {found:>4} results"
+                f"  p50 {p50:7.2f} ms  p95 {p95:7.2f} ms{flag}"
+            )
+    if slow:
+        print(f"{slow} searches were slower than {args.target_ms} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# Compares the cost of turning a page of clue rows into a JSON response
+# the old way (a dict per row, checked by the Clues pydantic model, checked
+# again and encoded by FastAPI) with the rows.py way (ClueRow records
+# encoded straight to JSON bytes with orjson). No database is needed.
+#
+# Run from the api directory:
+#   python -m benchmarks.serialization
+import json
+import timeit
+from fastapi.encoders import jsonable_encoder
+from routers.clues import Clues
+from rows import clue_record, encode
+
+
+def make_rows(count):
+    return [
+        (
+            n % 50, f"Category {n % 50}", True,
+            n, f"Question number {n}?", f"Answer {n}",
+            200 * (1 + n % 5), 0, True,
+        )
+        for n in range(count)
+    ]
+
+
+def old_way(rows):
+    results = []
+    for row in rows:
+        results.append({
+            "id": row[3],
+            "question": row[4],
+            "answer": row[5],
+            "value": row[6],
+            "invalid_count": row[7],
+            "canon": row[8],
+            "category": {
+                "id": row[0],
+                "title": row[1],
+                "canon": row[2],
+            }
+        })
+    page = Clues(page_count=1, clues=results)
+    # What FastAPI does with the returned model: checks it against the
+    # response_model again, then turns it into JSON
+    checked = Clues.parse_obj(page.dict())
+    return json.dumps(jsonable_encoder(checked)).encode()
+
+
+def new_way(rows):
+    return encode({
+        "page_count": 1,
+        "clues": [clue_record(row) for row in rows],
+        "next": None,
+    })
+
+
+def main():
+    for count in (100, 1000):
+        rows = make_rows(count)
+        assert json.loads(old_way(rows)) == json.loads(new_way(rows))
+        number = max(10000 // count, 5)
+        for name, func in (("dict + pydantic", old_way), ("rows + orjson", new_way)):
+            seconds = min(timeit.repeat(lambda: func(rows), number=number, repeat=5))
+            print(f"{count:>5} clues  {name:<16} {seconds / number * 1000:8.3f} ms per page")
+
+
+if __name__ == "__main__":
+    main()
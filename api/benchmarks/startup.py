@@ -0,0 +1,157 @@
+# Measures how long the server takes to start and to stop, to compare the
+# single uvicorn process of Dockerfile.dev with the gunicorn workers of
+# gunicorn.conf.py:
+#   - "import" is how long `import main` takes in a new interpreter, which
+#     every worker pays without preload_app
+#   - "ready" starts the server and times until /api/health answers 200
+#   - "stop" sends SIGTERM to a ready server and times until it exited,
+#     with its workers draining and closing their pools
+#
+# Needs the PG* and MONGO* environment variables like the server and
+# requirements-dev.txt installed. Run from the api directory:
+#   python -m benchmarks.startup
+#   python -m benchmarks.startup --servers gunicorn --workers 1 4 8 --runs 5
+import argparse
+import json
+import os
+import platform
+import signal
+import statistics
+import subprocess
+import sys
+import time
+import httpx
+
+IMPORT_MAIN = """
+import time
+start = time.perf_counter()
+import main
+print(time.perf_counter() - start)
+"""
+
+
+def time_import(api_mode):
+    env = dict(os.environ, API_MODE=api_mode)
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_MAIN],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return float(output.stdout.split()[-1])
+
+
+def server_command(server, port, workers):
+    if server == "uvicorn":
+        return [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)]
+    # the rest of the settings come from gunicorn.conf.py
+    return [
+        sys.executable, "-m", "gunicorn", "main:app",
+        "--bind", f"127.0.0.1:{port}",
+        "--workers", str(workers),
+    ]
+
+
+def wait_ready(process, url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("the server exited before it was ready")
+        try:
+            if httpx.get(url + "/api/health").status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.05)
+    raise RuntimeError(f"the server did not start in {timeout} seconds")
+
+
+def time_server(server, port, workers, api_mode, timeout):
+    env = dict(os.environ, API_MODE=api_mode)
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        server_command(server, port, workers),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_ready(process, f"http://127.0.0.1:{port}", timeout)
+        ready = time.perf_counter() - start
+        start = time.perf_counter()
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout)
+        stop = time.perf_counter() - start
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    return ready, stop
+
+
+def summary(seconds):
+    return {
+        "median": statistics.median(seconds),
+        "min": min(seconds),
+        "max": max(seconds),
+        "runs": seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--servers", nargs="+", choices=["uvicorn", "gunicorn"],
+                        default=["uvicorn", "gunicorn"])
+    parser.add_argument("--workers", type=int, nargs="+", default=[os.cpu_count()],
+                        help="gunicorn worker counts to try")
+    parser.add_argument("--api-modes", nargs="+", choices=["sync", "async"],
+                        default=["sync", "async"])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", default="startup-results.json")
+    args = parser.parse_args()
+
+    results = []
+    for api_mode in args.api_modes:
+        seconds = [time_import(api_mode) for _ in range(args.runs)]
+        results.append({"measure": "import", "api_mode": api_mode, **summary(seconds)})
+        print(f"import main ({api_mode}): {statistics.median(seconds) * 1000:.0f} ms")
+
+        for server in args.servers:
+            for workers in args.workers if server == "gunicorn" else [1]:
+                ready = []
+                stop = []
+                for _ in range(args.runs):
+                    run_ready, run_stop = time_server(
+                        server, args.port, workers, api_mode, args.timeout
+                    )
+                    ready.append(run_ready)
+                    stop.append(run_stop)
+                for measure, seconds in [("ready", ready), ("stop", stop)]:
+                    results.append({
+                        "measure": measure,
+                        "server": server,
+                        "workers": workers,
+                        "api_mode": api_mode,
+                        **summary(seconds),
+                    })
+                print(
+                    f"{server} x{workers} ({api_mode}): ready in "
+                    f"{statistics.median(ready):.2f} s, stopped in "
+                    f"{statistics.median(stop):.2f} s"
+                )
+
+    with open(args.output, "w") as output:
+        json.dump({
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "results": results,
+        }, output, indent=2)
+    print(f"wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
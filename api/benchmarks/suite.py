@@ -0,0 +1,290 @@
+# Runs every route of categories.py, clues.py and games.py against a
+# made-up dataset (see dataset.py) and writes throughput and p50/p95/p99
+# latency per route to a JSON file, so two runs can be compared before a
+# deploy.
+#
+# Each size is seeded into its own PostgreSQL schema and Mongo database,
+# then each route is driven at each concurrency level:
+#   - "asgi" calls the app in this process through httpx, without a
+#     network in between, so it measures the app and the databases
+#   - "http" starts uvicorn in a subprocess (or uses --url) and goes
+#     through a real socket
+#
+# Needs the PG* and MONGO* environment variables like the server and
+# requirements-dev.txt installed. Run from the api directory:
+#   python -m benchmarks.suite --sizes 10000 100000 --concurrency 1 10 50
+#   python -m benchmarks.suite --transports asgi --routes "GET /api/clue/{clue_id}"
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import httpx
+import psycopg
+import pymongo
+from . import dataset
+
+
+MONGO_DBNAME = "bench_suite"
+
+
+class Route:
+    def __init__(self, name, method, make_request):
+        # name is the route as written in the router, like "GET /api/clue/{clue_id}"
+        self.name = name
+        self.method = method
+        # make_request(rng) returns (path, json body or None)
+        self.make_request = make_request
+
+
+def routes(sizes):
+    categories = sizes.categories
+    clues = sizes.clues
+    games = sizes.games
+    # the spare categories have no clues, so they can be deleted
+    spare = itertools.count(categories + 1)
+    terms = dataset.search_terms(100, seed=1)
+
+    def ids(rng, top, n=20):
+        return [rng.randint(1, top) for _ in range(n)]
+
+    def get(path):
+        return lambda rng: (path(rng), None)
+
+    return [
+        # categories.py
+        Route("GET /api/categories/{page}", "GET",
+              get(lambda rng: f"/api/categories/{rng.randrange(categories // 100 + 1)}")),
+        Route("GET /api/categories?ids=", "GET",
+              get(lambda rng: "/api/categories?ids=" + ",".join(map(str, ids(rng, categories))))),
+        Route("POST /api/categories/lookup", "POST",
+              lambda rng: ("/api/categories/lookup", {"ids": ids(rng, categories)})),
+        Route("GET /api/category/{category_id}", "GET",
+              get(lambda rng: f"/api/category/{rng.randint(1, categories)}")),
+        Route("POST /api/categories", "POST",
+              lambda rng: ("/api/categories", {"title": f"Bench {rng.random()}"})),
+        Route("PUT /api/categories/{category_id}", "PUT",
+              lambda rng: (f"/api/categories/{rng.randint(1, categories)}",
+                           {"title": f"Bench {rng.random()}"})),
+        Route("DELETE /api/categories/{category_id}", "DELETE",
+              get(lambda rng: f"/api/categories/{next(spare)}")),
+        # clues.py
+        Route("GET /api/clues/search", "GET",
+              get(lambda rng: f"/api/clues/search?q={rng.choice(terms)}")),
+        Route("GET /api/clues/{page}", "GET",
+              get(lambda rng: f"/api/clues/{rng.randrange(clues // 100 + 1)}")),
+        Route("GET /api/clues?ids=", "GET",
+              get(lambda rng: "/api/clues?ids=" + ",".join(map(str, ids(rng, clues))))),
+        Route("POST /api/clues/lookup", "POST",
+              lambda rng: ("/api/clues/lookup", {"ids": ids(rng, clues)})),
+        Route("GET /api/clue/{clue_id}", "GET",
+              get(lambda rng: f"/api/clue/{rng.randint(1, clues)}")),
+        Route("GET /api/random-clue", "GET",
+              get(lambda rng: "/api/random-clue")),
+        Route("DELETE /api/clues/{clue_id}", "DELETE",
+              get(lambda rng: f"/api/clues/{rng.randint(1, clues)}")),
+        # games.py
+        Route("GET /api/games/{page}", "GET",
+              get(lambda rng: f"/api/games/{rng.randrange(games // 100 + 1)}")),
+        Route("GET /api/game/{game_id}", "GET",
+              get(lambda rng: f"/api/game/{rng.randint(1, games)}")),
+        Route("POST /api/custom-games", "POST",
+              lambda rng: ("/api/custom-games", None)),
+    ]
+
+
+def percentile(latencies, fraction):
+    # latencies must be sorted
+    if not latencies:
+        return None
+    index = min(int(len(latencies) * fraction), len(latencies) - 1)
+    return latencies[index] * 1000
+
+
+async def worker(client, route, rng, deadline, latencies, statuses):
+    while time.perf_counter() < deadline:
+        path, body = route.make_request(rng)
+        start = time.perf_counter()
+        try:
+            response = await client.request(route.method, path, json=body)
+            status = response.status_code
+        except httpx.HTTPError as error:
+            status = type(error).__name__
+        latencies.append(time.perf_counter() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+
+
+async def drive(client, route, concurrency, duration, seed):
+    latencies = []
+    statuses = {}
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[
+        worker(client, route, random.Random(seed + i), deadline, latencies, statuses)
+        for i in range(concurrency)
+    ])
+    latencies.sort()
+    errors = sum(
+        count for status, count in statuses.items()
+        # a 429 means the rate limit was measured, not the route
+        if not isinstance(status, int) or status >= 500 or status == 429
+    )
+    return {
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / duration,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "errors": errors,
+        "statuses": {str(status): count for status, count in statuses.items()},
+    }
+
+
+async def run_routes(client, transport, size, selected, args, results):
+    for route in selected:
+        for concurrency in args.concurrency:
+            result = await drive(client, route, concurrency, args.duration, args.seed)
+            result.update({
+                "transport": transport,
+                "clues": size,
+                "route": route.name,
+                "concurrency": concurrency,
+            })
+            results.append(result)
+            print(
+                f"{transport:<5} {size:>8} {route.name:<38} c={concurrency:<4}"
+                f" {result['requests_per_second']:8.1f} req/s"
+                f"  p50 {result['p50_ms'] or 0:7.1f}"
+                f"  p95 {result['p95_ms'] or 0:7.1f}"
+                f"  p99 {result['p99_ms'] or 0:7.1f} ms"
+                f"  errors {result['errors']}",
+                flush=True,
+            )
+
+
+async def run_asgi(size, selected, args, results):
+    # Imported here so the environment set in main() is in place first
+    import cache
+    import main
+
+    # Every size starts with an empty cache, the routes warm it up again
+    cache.cache.backend = cache._make_backend()
+    await main.app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=60
+        ) as client:
+            await run_routes(client, "asgi", size, selected, args, results)
+    finally:
+        await main.app.router.shutdown()
+
+
+def start_server(port):
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)],
+        env=os.environ.copy(),
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("uvicorn exited before it was ready")
+        try:
+            if httpx.get(url + "/api/health").status_code == 200:
+                return server, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("uvicorn did not start in 60 seconds")
+
+
+async def run_http(url, size, selected, args, results):
+    limits = httpx.Limits(max_connections=max(args.concurrency))
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        await run_routes(client, "http", size, selected, args, results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--transports", nargs="+", choices=["asgi", "http"],
+                        default=["asgi", "http"])
+    parser.add_argument("--url", help="use this running server for http")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--routes", nargs="+",
+                        help="only these routes, like \"GET /api/clue/{clue_id}\"")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the seeded data of the last size")
+    parser.add_argument("--output", default="benchmark-results.json")
+    args = parser.parse_args()
+
+    # Point the app, in this process and in uvicorn, at the seeded data.
+    # The cache is off unless asked for, so the databases are measured.
+    os.environ["PGOPTIONS"] = dataset.search_path_options()
+    os.environ["MONGODATABASE"] = MONGO_DBNAME
+    os.environ.setdefault("CACHE_BACKEND", "none")
+    # One client sends every request, the rate limits (see ratelimit.py)
+    # would answer most of them with 429s
+    os.environ.setdefault("RATE_LIMIT_BACKEND", "none")
+
+    mongo = pymongo.MongoClient(
+        f"mongodb://{os.environ['MONGOUSER']}:{os.environ['MONGOPASSWORD']}"
+        f"@{os.environ['MONGOHOST']}"
+    )
+    results = []
+    try:
+        with psycopg.connect() as conn:
+            for size in args.sizes:
+                sizes = dataset.Sizes(size)
+                start = time.perf_counter()
+                dataset.seed_postgres(conn, sizes)
+                dataset.seed_mongo(mongo[MONGO_DBNAME], sizes)
+                print(f"seeded {sizes.as_dict()} in {time.perf_counter() - start:.0f} s")
+
+                selected = [
+                    route for route in routes(sizes)
+                    if not args.routes or route.name in args.routes
+                ]
+                if "asgi" in args.transports:
+                    asyncio.run(run_asgi(size, selected, args, results))
+                if "http" in args.transports:
+                    server = None
+                    url = args.url
+                    if url is None:
+                        server, url = start_server(args.port)
+                    try:
+                        asyncio.run(run_http(url, size, selected, args, results))
+                    finally:
+                        if server is not None:
+                            server.terminate()
+                            server.wait()
+            if not args.keep:
+                dataset.drop_postgres(conn)
+                dataset.drop_mongo(mongo, MONGO_DBNAME)
+    finally:
+        mongo.close()
+
+    with open(args.output, "w") as output:
+        json.dump({
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "api_mode": os.environ.get("API_MODE", "sync"),
+            "cache_backend": os.environ["CACHE_BACKEND"],
+            "rate_limit_backend": os.environ["RATE_LIMIT_BACKEND"],
+            "duration": args.duration,
+            "results": results,
+        }, output, indent=2)
+    print(f"wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
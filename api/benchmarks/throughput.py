@@ -0,0 +1,65 @@
+# Measures how many requests per second a running server handles, to
+# compare API_MODE=sync with API_MODE=async. Start the server in one mode,
+# run this, restart it in the other mode and run this again (needs
+# requirements-dev.txt installed):
+#
+#   python -m benchmarks.throughput --url http://localhost:8000 \
+#       --concurrency 200 --duration 20 /api/clue/1 /api/categories/0
+import argparse
+import asyncio
+import time
+import httpx
+
+
+async def worker(client, path, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            response = await client.get(path)
+            if response.status_code >= 500:
+                errors.append(response.status_code)
+        except httpx.HTTPError as error:
+            errors.append(repr(error))
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(url, path, concurrency, duration):
+    latencies = []
+    errors = []
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=30) as client:
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*[
+            worker(client, path, deadline, latencies, errors)
+            for _ in range(concurrency)
+        ])
+    latencies.sort()
+    count = len(latencies)
+    return {
+        "requests_per_second": count / duration,
+        "p50_ms": latencies[count // 2] * 1000 if count else None,
+        "p99_ms": latencies[int(count * 0.99) - 1] * 1000 if count else None,
+        "errors": len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("paths", nargs="+")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        result = asyncio.run(run(args.url, path, args.concurrency, args.duration))
+        print(
+            f"{path:<30} {result['requests_per_second']:8.1f} req/s"
+            f"  p50 {result['p50_ms'] or 0:7.1f} ms"
+            f"  p99 {result['p99_ms'] or 0:7.1f} ms"
+            f"  errors {result['errors']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
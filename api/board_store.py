@@ -0,0 +1,281 @@
+import os
+import random
+import threading
+import time
+
+
+# A whole board for /api/boards (see routers/boards.py): a category with
+# its valid clues grouped by value. Instead of joining categories and
+# clues on every request, each board is kept ready in the category_boards
+# table (see the 006_category_boards migration in schema.py) as the JSON
+# the route sends, so a board is one primary key lookup and the JSON is
+# sent as it is.
+#
+# Triggers on categories and clues mark a board stale when something on
+# it changes. A background thread claims the stale boards in batches and
+# builds them again, the claim and the build of a batch in one
+# transaction. If the build fails the claim is rolled back with it and the
+# boards are still stale for the next round. A change made while building
+# waits for the claimed row to be unlocked and then marks the board stale
+# again, so it is built once more on the next round.
+#
+# Boards are sent while they are being rebuilt, so a change can take up
+# to BOARD_REFRESH_INTERVAL seconds to show. A board that was never built
+# is built by the request that asks for it.
+
+# A board needs clues for this many different values to be playable
+BOARD_VALUES = int(os.environ.get("BOARD_VALUES", 5))
+
+# How many stale boards one batch rebuilds
+BOARD_BATCH_SIZE = int(os.environ.get("BOARD_BATCH_SIZE", 500))
+
+CLAIM_STALE = """
+    UPDATE category_boards
+    SET stale = false
+    WHERE category_id IN (
+        SELECT category_id
+        FROM category_boards
+        WHERE stale
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING category_id
+"""
+
+# Builds the boards of the given categories. The clues of each value are
+# ordered by id so a board comes out the same every time it is built.
+BUILD_BOARDS = """
+    UPDATE category_boards
+    SET board = built.board,
+        playable = built.playable,
+        refreshed_on = clock_timestamp()
+    FROM (
+        SELECT categories.id,
+            jsonb_build_object(
+                'category', jsonb_build_object(
+                    'id', categories.id,
+                    'title', categories.title,
+                    'canon', categories.canon
+                ),
+                'values', COALESCE(board_values.values, '[]'::jsonb)
+            ) AS board,
+            COALESCE(board_values.count, 0) >= %s AS playable
+        FROM categories
+            LEFT JOIN LATERAL (
+                SELECT
+                    jsonb_agg(
+                        jsonb_build_object('value', by_value.value, 'clues', by_value.clues)
+                        ORDER BY by_value.value
+                    ) AS values,
+                    count(*) AS count
+                FROM (
+                    SELECT clues.value,
+                        jsonb_agg(
+                            jsonb_build_object(
+                                'id', clues.id,
+                                'question', clues.question,
+                                'answer', clues.answer,
+                                'value', clues.value,
+                                'invalid_count', clues.invalid_count,
+                                'canon', clues.canon
+                            )
+                            ORDER BY clues.id
+                        ) AS clues
+                    FROM clues
+                    WHERE clues.category_id = categories.id
+                        AND clues.invalid_count = 0
+                        AND clues.value IS NOT NULL
+                    GROUP BY clues.value
+                ) AS by_value
+            ) AS board_values ON true
+        WHERE categories.id = ANY(%s)
+    ) AS built
+    WHERE category_boards.category_id = built.id
+"""
+
+# The board is sent as text so it doesn't have to be decoded and encoded
+# again
+GET_BOARD = """
+    SELECT board::text
+    FROM category_boards
+    WHERE category_id = %s
+"""
+
+PLAYABLE_RANGE = """
+    SELECT MIN(category_id), MAX(category_id)
+    FROM category_boards
+    WHERE playable
+"""
+
+# The first playable board at or after each of the random ids, each one
+# an index lookup. Gaps in the ids make some boards a bit more likely than
+# others, which is fine for a game.
+RANDOM_BOARDS = """
+    SELECT picked.category_id, picked.board::text
+    FROM unnest(%s::integer[]) AS starts(id)
+        CROSS JOIN LATERAL (
+            SELECT category_boards.category_id, category_boards.board
+            FROM category_boards
+            WHERE category_boards.playable
+                AND category_boards.category_id >= starts.id
+            ORDER BY category_boards.category_id
+            LIMIT 1
+        ) AS picked
+"""
+
+# How many times to pick again when the random ids gave the same board
+MAX_RETRIES = 5
+
+
+def random_starts(low, high, n):
+    return [random.randint(low, high) for _ in range(n)]
+
+
+def board_body(board):
+    # board is the JSON text from the table
+    return board.encode()
+
+
+def boards_body(boards):
+    return b'{"boards":[' + b",".join(board.encode() for board in boards) + b"]}"
+
+
+class BoardStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.built = 0
+        self.on_demand = 0
+        self.refreshes = 0
+        self.failures = 0
+        self.last_refresh_seconds = 0.0
+
+    def build(self, conn, category_ids):
+        with conn.cursor() as cur:
+            cur.execute(BUILD_BOARDS, [BOARD_VALUES, category_ids])
+        with self.lock:
+            self.built += len(category_ids)
+
+    def get(self, conn, category_id):
+        # The JSON text of a board, or None if there is no such category
+        with conn.cursor() as cur:
+            cur.execute(GET_BOARD, [category_id])
+            row = cur.fetchone()
+            if row is None:
+                return None
+            if row[0] is None:
+                # never built yet
+                self.build(conn, [category_id])
+                with self.lock:
+                    self.on_demand += 1
+                cur.execute(GET_BOARD, [category_id])
+                row = cur.fetchone()
+            return row[0]
+
+    async def get_async(self, conn, category_id):
+        async with conn.cursor() as cur:
+            await cur.execute(GET_BOARD, [category_id])
+            row = await cur.fetchone()
+            if row is None:
+                return None
+            if row[0] is None:
+                await cur.execute(BUILD_BOARDS, [BOARD_VALUES, [category_id]])
+                with self.lock:
+                    self.built += 1
+                    self.on_demand += 1
+                await cur.execute(GET_BOARD, [category_id])
+                row = await cur.fetchone()
+            return row[0]
+
+    def random(self, conn, n):
+        # The JSON text of n different random playable boards, fewer if
+        # there are not that many
+        picked = {}
+        with conn.cursor() as cur:
+            cur.execute(PLAYABLE_RANGE)
+            low, high = cur.fetchone()
+            if low is None:
+                return []
+            for _ in range(MAX_RETRIES):
+                cur.execute(RANDOM_BOARDS, [random_starts(low, high, n - len(picked))])
+                picked.update(cur.fetchall())
+                if len(picked) >= n:
+                    break
+        return list(picked.values())[:n]
+
+    async def random_async(self, conn, n):
+        picked = {}
+        async with conn.cursor() as cur:
+            await cur.execute(PLAYABLE_RANGE)
+            low, high = await cur.fetchone()
+            if low is None:
+                return []
+            for _ in range(MAX_RETRIES):
+                await cur.execute(
+                    RANDOM_BOARDS, [random_starts(low, high, n - len(picked))]
+                )
+                picked.update(await cur.fetchall())
+                if len(picked) >= n:
+                    break
+        return list(picked.values())[:n]
+
+    def refresh(self, pool):
+        # Rebuilds the stale boards, a batch per transaction
+        started = time.monotonic()
+        while not _refresher_stop.is_set():
+            # the pool commits when the block ends and rolls back on an
+            # exception, see above
+            with pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(CLAIM_STALE, [BOARD_BATCH_SIZE])
+                    category_ids = [row[0] for row in cur.fetchall()]
+                if not category_ids:
+                    break
+                self.build(conn, category_ids)
+        with self.lock:
+            self.refreshes += 1
+            self.last_refresh_seconds = time.monotonic() - started
+
+    def stats(self):
+        with self.lock:
+            return {
+                "built": self.built,
+                "on_demand": self.on_demand,
+                "refreshes": self.refreshes,
+                "failures": self.failures,
+                "last_refresh_seconds": self.last_refresh_seconds,
+            }
+
+
+store = BoardStore()
+
+_refresher = None
+_refresher_stop = threading.Event()
+
+
+def start(pool):
+    # Rebuilds stale boards in a background thread
+    global _refresher
+    _refresher_stop.clear()
+    _refresher = threading.Thread(target=_refresh, args=(pool,), daemon=True)
+    _refresher.start()
+
+
+def stop():
+    global _refresher
+    _refresher_stop.set()
+    if _refresher is not None:
+        _refresher.join()
+        _refresher = None
+
+
+def _refresh(pool):
+    interval = float(os.environ.get("BOARD_REFRESH_INTERVAL", 5))
+    while True:
+        try:
+            store.refresh(pool)
+        except Exception:
+            # the database may be down, try again on the next round
+            with store.lock:
+                store.failures += 1
+        if _refresher_stop.wait(interval):
+            return
@@ -0,0 +1,181 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+# A read-through cache for the detail and list routes. The routes look up
+# the response here first and only query the database on a miss:
+#
+#   key = cache.key("clue", clue_id)
+#   record = cache.get(key)
+#   if record is None:
+#       record = encode(...query...)
+#       cache.set(key, record)
+#
+# The cached values are the encoded JSON bodies (see rows.py), so a hit
+# is sent back as is without encoding it again.
+#
+# The routes that write call cache.delete(...) for the entries they change.
+# Groups of entries that are hard to list one by one, like every page of
+# the clue list, share a namespace; cache.clear_namespace("clues-page")
+# makes all of them miss by bumping the namespace's version, which is part
+# of every key built with cache.key.
+#
+# CACHE_BACKEND picks where entries are kept: "memory" (the default) is an
+# LRU dict in this process, "redis" uses the server at REDIS_URL so all
+# workers share one cache, and "none" turns caching off.
+
+
+class MemoryBackend:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            # most recently used entries live at the end
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def version(self, namespace):
+        with self.lock:
+            return self.versions.get(namespace, 0)
+
+    def bump(self, namespace):
+        with self.lock:
+            self.versions[namespace] = self.versions.get(namespace, 0) + 1
+
+    def size(self):
+        return len(self.entries)
+
+
+class RedisBackend:
+    def __init__(self, url, ttl):
+        # only needed when CACHE_BACKEND is "redis"
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.redis.get(key)
+
+    def set(self, key, value):
+        # in milliseconds, so a CACHE_TTL under a second still works
+        self.redis.set(key, value, px=int(self.ttl * 1000))
+
+    def delete(self, key):
+        self.redis.delete(key)
+
+    def version(self, namespace):
+        return int(self.redis.get(f"version:{namespace}") or 0)
+
+    def bump(self, namespace):
+        self.redis.incr(f"version:{namespace}")
+
+    def size(self):
+        return self.redis.dbsize()
+
+
+class NoBackend:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def version(self, namespace):
+        return 0
+
+    def bump(self, namespace):
+        pass
+
+    def size(self):
+        return 0
+
+
+class Cache:
+    def __init__(self, backend):
+        self.backend = backend
+        # the sync routes run in a thread pool, += on the counters is not
+        # atomic
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, namespace, *parts):
+        version = self.backend.version(namespace)
+        return ":".join([namespace, str(version)] + [str(part) for part in parts])
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def delete(self, namespace, *parts):
+        self.backend.delete(self.key(namespace, *parts))
+
+    def clear_namespace(self, namespace):
+        self.backend.bump(namespace)
+
+    def stats(self):
+        with self.lock:
+            hits, misses = self.hits, self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "size": self.backend.size(),
+            "hits": hits,
+            "misses": misses,
+        }
+
+
+def _make_backend():
+    backend = os.environ.get("CACHE_BACKEND", "memory")
+    if backend == "none":
+        return NoBackend()
+    ttl = float(os.environ.get("CACHE_TTL", 60))
+    # Redis keeps entries for whole milliseconds, checked here so a bad
+    # value stops the server when it starts instead of failing every write
+    if ttl < 0.001:
+        raise ValueError(
+            f"CACHE_TTL is {ttl}, it must be at least 0.001 seconds "
+            "(CACHE_BACKEND=none turns the cache off)"
+        )
+    if backend == "redis":
+        return RedisBackend(os.environ.get("REDIS_URL", "redis://localhost:6379/0"), ttl)
+    return MemoryBackend(int(os.environ.get("CACHE_MAX_SIZE", 10000)), ttl)
+
+
+cache = Cache(_make_backend())
@@ -0,0 +1,299 @@
+import os
+import select
+import threading
+import time
+import psycopg
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError
+import schema
+
+
+# Category reads come from Mongo but category writes go to PostgreSQL,
+# so Mongo has to be told about every change.
+#
+# A trigger on categories (see the 004_category_changes migration in
+# schema.py) writes the id of every changed category to the
+# category_changes table, in the same transaction as the change, and sends
+# a NOTIFY. The consumer thread here LISTENs for it, reads the changes in
+# batches, copies those categories to Mongo with one bulk_write and deletes
+# the changes it applied. A change is only deleted after Mongo has it, so
+# nothing is lost if the server stops in between; it is just applied again.
+#
+# load_all copies everything to Mongo at once, to fill an empty Mongo or to
+# catch up after the sync was off:
+#   python -m category_sync load
+
+SYNC_ENABLED = os.environ.get("CATEGORY_SYNC", "on") == "on"
+
+# How many changes one batch applies
+BATCH_SIZE = int(os.environ.get("CATEGORY_SYNC_BATCH", 500))
+
+# How many documents go in one bulk_write of load_all
+LOAD_CHUNK = int(os.environ.get("CATEGORY_LOAD_CHUNK", 10000))
+
+CHANNEL = "category_changes"
+
+# The oldest changes first. SKIP LOCKED lets more than one server process
+# consume at the same time without applying the same batch twice. Two
+# processes can still get changes of the same category in different
+# batches and write them to Mongo in the wrong order, see category_update.
+NEXT_CHANGES = """
+    SELECT id, category_id,
+        EXTRACT(EPOCH FROM clock_timestamp() - changed_on)
+    FROM category_changes
+    ORDER BY id
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+"""
+
+
+# The fields of a category document that come from PostgreSQL, from a
+# (id, title, canon, updated_at) row
+def category_fields(row):
+    return {
+        "title": row[1],
+        "canon": row[2],
+        # for the ETag of /api/category, see conditional.py
+        "updated_at": row[3],
+    }
+
+
+def category_update(row):
+    # Only sets the fields when the document is not newer than the row, so
+    # an older copy of the category that reaches Mongo last (from another
+    # process, or from the COPY of load_all) can't overwrite a newer one.
+    # A document without updated_at is from before the 007 migration.
+    # When the document is newer the filter finds nothing and the upsert
+    # tries to insert it again, which is the duplicate key error that
+    # _bulk_write ignores.
+    return UpdateOne(
+        {"_id": row[0], "updated_at": {"$not": {"$gt": row[3]}}},
+        {"$set": category_fields(row)},
+        upsert=True,
+    )
+
+
+def _bulk_write(collection, requests):
+    try:
+        collection.bulk_write(requests, ordered=False)
+    except BulkWriteError as error:
+        # 11000 is a duplicate key, a newer document was already there
+        details = error.details
+        if details["writeConcernErrors"] or any(
+            write_error["code"] != 11000 for write_error in details["writeErrors"]
+        ):
+            raise
+
+
+class CategorySync:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.applied = 0
+        self.batches = 0
+        self.failures = 0
+        # seconds between the oldest change of the last batch being made
+        # and it reaching Mongo
+        self.last_lag_seconds = 0.0
+        self.last_applied_at = None
+        self.loaded = 0
+
+    def apply_batch(self, conn, mongo_db, on_applied=None):
+        # Applies up to BATCH_SIZE changes, returns how many there were
+        with conn.transaction():
+            with conn.cursor() as cur:
+                cur.execute(NEXT_CHANGES, [BATCH_SIZE])
+                changes = cur.fetchall()
+                if not changes:
+                    return 0
+                category_ids = sorted({change[1] for change in changes})
+                cur.execute(
+                    """
+                    SELECT id, title, canon, updated_at
+                    FROM categories
+                    WHERE id = ANY(%s)
+                """,
+                    [category_ids],
+                )
+                rows = {row[0]: row for row in cur.fetchall()}
+                # Whatever is not in categories any more was deleted
+                # Only the fields PostgreSQL has are set, anything else kept
+                # in the Mongo document stays
+                _bulk_write(mongo_db.categories, [
+                    category_update(rows[category_id])
+                    if category_id in rows
+                    else DeleteOne({"_id": category_id})
+                    for category_id in category_ids
+                ])
+                cur.execute(
+                    "DELETE FROM category_changes WHERE id = ANY(%s)",
+                    [[change[0] for change in changes]],
+                )
+        with self.lock:
+            self.applied += len(changes)
+            self.batches += 1
+            self.last_lag_seconds = float(max(change[2] for change in changes))
+            self.last_applied_at = time.time()
+        if on_applied is not None:
+            on_applied(category_ids)
+        return len(changes)
+
+    def apply_all(self, conn, mongo_db, on_applied=None):
+        total = 0
+        while True:
+            applied = self.apply_batch(conn, mongo_db, on_applied)
+            total += applied
+            if applied < BATCH_SIZE:
+                return total
+
+    def load_all(self, conn, mongo_db):
+        # Copies all categories, and the category of every clue for the
+        # clue counts, to Mongo. The documents are updated in place with
+        # only the fields PostgreSQL has, so whatever else Mongo keeps in
+        # them stays, and categories that are no longer in PostgreSQL are
+        # deleted afterwards. Changes made while this runs are still in
+        # category_changes and are applied again by the consumer afterwards.
+        loaded = 0
+        with conn.cursor() as cur:
+            for collection, sql, types, to_update in [
+                (
+                    "categories",
+                    "COPY (SELECT id, title, canon, updated_at FROM categories) TO STDOUT",
+                    ["int4", "text", "bool", "timestamptz"],
+                    category_update,
+                ),
+                (
+                    "clues",
+                    "COPY (SELECT id, category_id FROM clues) TO STDOUT",
+                    ["int4", "int4"],
+                    lambda row: UpdateOne(
+                        {"_id": row[0]}, {"$set": {"category_id": row[1]}}, upsert=True
+                    ),
+                ),
+            ]:
+                chunk = []
+                with cur.copy(sql) as copy:
+                    copy.set_types(types)
+                    for row in copy.rows():
+                        chunk.append(to_update(row))
+                        if len(chunk) == LOAD_CHUNK:
+                            _bulk_write(mongo_db[collection], chunk)
+                            loaded += len(chunk)
+                            chunk = []
+                if chunk:
+                    _bulk_write(mongo_db[collection], chunk)
+                    loaded += len(chunk)
+            schema.create_mongo_indexes(mongo_db)
+            self._delete_missing(cur, mongo_db)
+        with self.lock:
+            self.loaded += loaded
+        return loaded
+
+    def _delete_missing(self, cur, mongo_db):
+        # Reads the Mongo ids before the PostgreSQL ones, so a category
+        # created in between is in neither list instead of only looking
+        # deleted. Ids are never used again, so one that is in Mongo but
+        # not in PostgreSQL was deleted.
+        in_mongo = [doc["_id"] for doc in mongo_db.categories.find({}, {"_id": 1})]
+        cur.execute("SELECT id FROM categories")
+        in_postgres = {row[0] for row in cur.fetchall()}
+        missing = [category_id for category_id in in_mongo if category_id not in in_postgres]
+        for start in range(0, len(missing), LOAD_CHUNK):
+            mongo_db.categories.delete_many(
+                {"_id": {"$in": missing[start:start + LOAD_CHUNK]}}
+            )
+
+    def stats(self):
+        with self.lock:
+            return {
+                "enabled": SYNC_ENABLED,
+                "applied": self.applied,
+                "batches": self.batches,
+                "failures": self.failures,
+                "last_lag_seconds": self.last_lag_seconds,
+                "seconds_since_last_applied": (
+                    time.time() - self.last_applied_at
+                    if self.last_applied_at is not None else None
+                ),
+                "loaded": self.loaded,
+            }
+
+
+def pending(conn):
+    # How many changes are waiting and how old the oldest one is, for the
+    # health check
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT COUNT(*),
+                COALESCE(EXTRACT(EPOCH FROM clock_timestamp() - MIN(changed_on)), 0)
+            FROM category_changes
+        """
+        )
+        count, oldest = cur.fetchone()
+        return {"pending": count, "oldest_pending_seconds": float(oldest)}
+
+
+sync = CategorySync()
+
+_consumer = None
+_consumer_stop = threading.Event()
+
+
+def start(pool, mongo_db, on_applied=None):
+    # Applies changes in a background thread as they are made
+    global _consumer
+    if not SYNC_ENABLED:
+        return
+    _consumer_stop.clear()
+    _consumer = threading.Thread(
+        target=_consume,
+        args=(pool, mongo_db, on_applied),
+        daemon=True,
+    )
+    _consumer.start()
+
+
+def stop():
+    global _consumer
+    _consumer_stop.set()
+    if _consumer is not None:
+        _consumer.join()
+        _consumer = None
+
+
+def _consume(pool, mongo_db, on_applied):
+    # Also looks for changes every CATEGORY_SYNC_INTERVAL seconds in case a
+    # NOTIFY was missed while not listening
+    interval = float(os.environ.get("CATEGORY_SYNC_INTERVAL", 5))
+    while not _consumer_stop.is_set():
+        try:
+            # LISTEN needs its own connection that stays open, so it is not
+            # borrowed from the pool
+            with psycopg.connect(autocommit=True) as listener:
+                listener.execute(f"LISTEN {CHANNEL}")
+                while not _consumer_stop.is_set():
+                    with pool.connection() as conn:
+                        sync.apply_all(conn, mongo_db, on_applied)
+                    # Sleeps until a NOTIFY arrives or the interval is up,
+                    # any query then reads the notifications that came in
+                    ready, _, _ = select.select([listener], [], [], interval)
+                    if ready:
+                        listener.execute("SELECT 1")
+        except Exception:
+            # the database or Mongo may be down, try again after a while
+            with sync.lock:
+                sync.failures += 1
+            _consumer_stop.wait(interval)
+
+
+if __name__ == "__main__":
+    import sys
+    import db
+
+    with psycopg.connect() as conn:
+        mongo_db = db.open_mongo()[db.mongo_dbname]
+        if sys.argv[1:] == ["load"]:
+            print(f"loaded {sync.load_all(conn, mongo_db)} documents")
+        else:
+            print(f"applied {sync.apply_all(conn, mongo_db)} changes")
+        db.close_mongo()
@@ -0,0 +1,115 @@
+import hashlib
+import os
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Response
+from rows import json_response
+
+
+# Conditional GETs. Responses carry an ETag (and Last-Modified when we know
+# when the data changed), and a client or CDN that sends it back in
+# If-None-Match gets an empty 304 Not Modified instead of the whole body.
+#
+# The detail routes (/api/clue, /api/category, /api/game) use the
+# updated_at columns from the 007_updated_at migration in schema.py as a
+# version, so the ETag is known from a cheap version lookup (or from the
+# cache) without building the response. The list pages use a hash of the
+# encoded page, which is free when the page is cached.
+#
+# Each kind of route also gets its own Cache-Control header.
+
+DETAIL_CACHE_CONTROL = os.environ.get("CACHE_CONTROL_DETAIL", "public, max-age=60")
+LIST_CACHE_CONTROL = os.environ.get("CACHE_CONTROL_LIST", "public, max-age=30")
+# for the random routes, every response is different
+NO_STORE = "no-store"
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def as_utc(updated_at):
+    # pymongo gives naive datetimes that are in UTC
+    if updated_at.tzinfo is None:
+        return updated_at.replace(tzinfo=timezone.utc)
+    return updated_at
+
+
+def micros(updated_at):
+    # exact, unlike going through a float timestamp
+    return (as_utc(updated_at) - EPOCH) // timedelta(microseconds=1)
+
+
+def version_etag(kind, id, updated_at):
+    return f'"{kind}-{id}-{micros(updated_at)}"'
+
+
+def content_etag(body):
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def has_validators(request):
+    return (
+        "if-none-match" in request.headers
+        or "if-modified-since" in request.headers
+    )
+
+
+def not_modified(request, etag, updated_at=None):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match wins over If-Modified-Since when both are sent.
+        # Weak and strong tags compare the same for a GET.
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None and updated_at is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        # HTTP dates have whole seconds
+        return as_utc(updated_at).replace(microsecond=0) <= since
+    return False
+
+
+def validator_headers(etag, updated_at, cache_control):
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if updated_at is not None:
+        headers["Last-Modified"] = format_datetime(
+            as_utc(updated_at).astimezone(timezone.utc), usegmt=True
+        )
+    return headers
+
+
+def not_modified_response(etag, updated_at, cache_control):
+    return Response(
+        status_code=304,
+        headers=validator_headers(etag, updated_at, cache_control),
+    )
+
+
+def validated_response(request, body, etag, updated_at=None, cache_control=DETAIL_CACHE_CONTROL):
+    # body is the encoded JSON, see rows.py
+    if not_modified(request, etag, updated_at):
+        return not_modified_response(etag, updated_at, cache_control)
+    return json_response(
+        body,
+        headers=validator_headers(etag, updated_at, cache_control),
+    )
+
+
+def page_response(request, body, cache_control=LIST_CACHE_CONTROL):
+    return validated_response(request, body, content_etag(body), None, cache_control)
+
+
+# The detail routes keep the version next to the body in the cache, as
+# "<microseconds>\n<body>", so a cached response still has its ETag
+def pack(updated_at, body):
+    return str(micros(updated_at)).encode() + b"\n" + body
+
+
+def unpack(value):
+    version, body = value.split(b"\n", 1)
+    return EPOCH + timedelta(microseconds=int(version)), body
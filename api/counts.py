@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+
+
+# The list routes only need the number of rows to fill in page_count, but
+# COUNT(*) reads the whole table every time. Instead the totals are kept
+# here for COUNT_TTL seconds, and the routes that add or remove rows call
+# forget() so the next page view counts again.
+#
+# COUNT_MODE picks how a total is found when it is not cached:
+#   "exact"     COUNT(*) in PostgreSQL, count_documents in Mongo
+#   "estimate"  the row count PostgreSQL keeps in pg_class.reltuples
+#               (updated by VACUUM and ANALYZE) and Mongo's
+#               estimatedDocumentCount, both read without a scan
+#
+# A route called with ?exact=true skips all of this and counts the rows.
+
+COUNT_MODE = os.environ.get("COUNT_MODE", "exact")
+COUNT_TTL = float(os.environ.get("COUNT_TTL", 60))
+
+# Table names are put in the SQL, so only these are allowed
+TABLES = {"categories", "clues", "games"}
+
+ESTIMATE = """
+    SELECT reltuples::bigint
+    FROM pg_class
+    WHERE oid = to_regclass(%s)
+"""
+
+
+class Counts:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # (database, table) -> (count, expires)
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.exact = 0
+
+    def cached(self, key):
+        with self.lock:
+            entry = self.counts.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def store(self, key, count):
+        with self.lock:
+            self.counts[key] = (count, time.monotonic() + self.ttl)
+        return count
+
+    def forget(self, table):
+        # After rows were added to or removed from table
+        with self.lock:
+            for key in [key for key in self.counts if key[1] == table]:
+                del self.counts[key]
+
+    def table(self, conn, table, exact=False):
+        # The number of rows in a PostgreSQL table
+        key = ("postgres", table)
+        if not exact:
+            count = self.cached(key)
+            if count is not None:
+                return count
+        with conn.cursor() as cur:
+            count = None
+            if COUNT_MODE == "estimate" and not exact:
+                cur.execute(ESTIMATE, [table])
+                count = _estimate(cur.fetchone())
+            if count is None:
+                cur.execute(_count_sql(table))
+                count = cur.fetchone()[0]
+        return self._counted(key, count, exact)
+
+    async def table_async(self, conn, table, exact=False):
+        key = ("postgres", table)
+        if not exact:
+            count = self.cached(key)
+            if count is not None:
+                return count
+        async with conn.cursor() as cur:
+            count = None
+            if COUNT_MODE == "estimate" and not exact:
+                await cur.execute(ESTIMATE, [table])
+                count = _estimate(await cur.fetchone())
+            if count is None:
+                await cur.execute(_count_sql(table))
+                count = (await cur.fetchone())[0]
+        return self._counted(key, count, exact)
+
+    def collection(self, db, name, exact=False):
+        # The number of documents in a Mongo collection
+        key = ("mongo", name)
+        if not exact:
+            count = self.cached(key)
+            if count is not None:
+                return count
+        if COUNT_MODE == "estimate" and not exact:
+            count = db[name].estimated_document_count()
+        else:
+            count = db[name].count_documents({})
+        return self._counted(key, count, exact)
+
+    async def collection_async(self, db, name, exact=False):
+        key = ("mongo", name)
+        if not exact:
+            count = self.cached(key)
+            if count is not None:
+                return count
+        if COUNT_MODE == "estimate" and not exact:
+            count = await db[name].estimated_document_count()
+        else:
+            count = await db[name].count_documents({})
+        return self._counted(key, count, exact)
+
+    def _counted(self, key, count, exact):
+        if exact:
+            with self.lock:
+                self.exact += 1
+        # an exact count is the best value to keep as well
+        return self.store(key, count)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "mode": COUNT_MODE,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "exact": self.exact,
+            }
+
+
+def _count_sql(table):
+    if table not in TABLES:
+        raise ValueError(f"unknown table {table}")
+    return f"SELECT COUNT(*) FROM {table}"
+
+
+def _estimate(row):
+    # reltuples is -1 for a table that was never vacuumed or analyzed, and
+    # 0 can mean the same on older PostgreSQL, so those are counted instead
+    if row is None or row[0] <= 0:
+        return None
+    return row[0]
+
+
+counts = Counts(COUNT_TTL)
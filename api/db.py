@@ -0,0 +1,344 @@
+import asyncio
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from fastapi import HTTPException, status
+from psycopg_pool import AsyncConnectionPool, ConnectionPool, PoolTimeout
+import pymongo
+from pymongo import monitoring
+import metrics
+import schema
+
+
+# "sync" runs the routes as plain functions in FastAPI's thread pool,
+# "async" swaps in the async versions of the routes (see main.py) which
+# use the async pool and Mongo client below, so one worker can wait on
+# many queries at once
+API_MODE = os.environ.get("API_MODE", "sync")
+
+
+# One connection pool is shared by every router in the process so that a
+# request borrows an already-open connection instead of paying for a new
+# TCP + auth handshake with psycopg.connect() every time.
+# The connection settings still come from the PG* environment variables
+# (see the "environment" section of docker-compose.yaml), the pool sizing
+# comes from the PGPOOL_* variables below.
+pool = None
+
+# Counts how many requests gave up waiting for a free connection
+pool_timeouts = 0
+
+_checker = None
+_checker_stop = threading.Event()
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+def open_pool():
+    global pool, _checker
+    if pool is not None:
+        return pool
+    min_size = _env_int("PGPOOL_MIN_SIZE", 2)
+    pool = ConnectionPool(
+        # an empty conninfo means "use the PG* environment variables"
+        "",
+        name="trivia-game",
+        min_size=min_size,
+        max_size=_env_int("PGPOOL_MAX_SIZE", max(min_size, 10)),
+        # connections are closed and replaced after this many seconds
+        max_lifetime=_env_float("PGPOOL_MAX_LIFETIME", 3600),
+        # idle connections above min_size are closed after this many seconds
+        max_idle=_env_float("PGPOOL_MAX_IDLE", 600),
+        # how long a request waits for a connection before giving up
+        timeout=_env_float("PGPOOL_TIMEOUT", 5),
+        # every query is timed, see metrics.py
+        configure=metrics.timed_connection,
+    )
+    # Periodically make sure the idle connections in the pool still work,
+    # broken ones are thrown away and replaced by the pool.
+    interval = _env_float("PGPOOL_CHECK_INTERVAL", 60)
+    if interval > 0:
+        _checker_stop.clear()
+        _checker = threading.Thread(
+            target=_check_pool, args=(interval,), daemon=True
+        )
+        _checker.start()
+    return pool
+
+
+def close_pool():
+    global pool, _checker
+    _checker_stop.set()
+    if _checker is not None:
+        _checker.join()
+        _checker = None
+    if pool is not None:
+        pool.close()
+        pool = None
+
+
+def _check_pool(interval):
+    while not _checker_stop.wait(interval):
+        try:
+            pool.check()
+        except Exception:
+            # the pool may be closing, try again on the next round
+            pass
+
+
+def pool_stats():
+    if pool is None:
+        return {}
+    stats = pool.get_stats()
+    stats["pool_timeouts"] = pool_timeouts
+    return stats
+
+
+# Borrows a connection from the pool for the length of a with block.
+# Like psycopg.connect(), the transaction is committed at the end of the
+# block, or rolled back if the block raised an exception.
+@contextmanager
+def connection():
+    global pool_timeouts
+    started = time.perf_counter()
+    try:
+        with pool.connection() as conn:
+            metrics.record_pool_wait("sync", time.perf_counter() - started)
+            yield conn
+    except PoolTimeout:
+        pool_timeouts += 1
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Database is busy, try again later",
+        )
+
+
+# Used as a dependency by the routes, for example
+#   def get_clue(clue_id: int, conn=Depends(get_conn)):
+# The connection goes back to the pool when the request is done.
+def get_conn():
+    with connection() as conn:
+        yield conn
+
+
+# Like the PostgreSQL pool, one MongoClient is created when the server starts
+# and shared by every request. Each MongoClient owns its own connection pool
+# and monitor threads, so making a new one per request leaks them.
+mongo_client = None
+mongo_dbname = None
+
+
+class MongoPoolStats(monitoring.ConnectionPoolListener):
+    # Keeps counts of what happens in the MongoClient connection pool so
+    # they can be reported by the health check
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = 0
+        self.checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+
+    def _add(self, name, amount):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add("open", 1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add("open", -1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._add("checkout_failures", 1)
+
+    def connection_checked_out(self, event):
+        self._add("checked_out", 1)
+        self._add("checkouts", 1)
+
+    def connection_checked_in(self, event):
+        self._add("checked_out", -1)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "open": self.open,
+                "checked_out": self.checked_out,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+            }
+
+
+mongo_pool_stats = MongoPoolStats()
+
+
+def _mongo_url():
+    dbhost = os.environ["MONGOHOST"]
+    dbuser = os.environ["MONGOUSER"]
+    dbpass = os.environ["MONGOPASSWORD"]
+    return f"mongodb://{dbuser}:{dbpass}@{dbhost}"
+
+
+def open_mongo():
+    global mongo_client, mongo_dbname
+    if mongo_client is not None:
+        return mongo_client
+    mongo_dbname = os.environ["MONGODATABASE"]
+    mongo_client = pymongo.MongoClient(
+        _mongo_url(),
+        maxPoolSize=_env_int("MONGO_MAX_POOL_SIZE", 100),
+        minPoolSize=_env_int("MONGO_MIN_POOL_SIZE", 0),
+        # how long to wait for a usable server before failing a query,
+        # in milliseconds
+        serverSelectionTimeoutMS=_env_int("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+        # how long a query waits for a free connection, in milliseconds
+        waitQueueTimeoutMS=_env_int("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000),
+        event_listeners=[mongo_pool_stats, metrics.mongo_listener],
+    )
+    # The indexes the routes need, see schema.py
+    if schema.MIGRATE_ON_STARTUP:
+        schema.create_mongo_indexes(mongo_client[mongo_dbname])
+    return mongo_client
+
+
+def close_mongo():
+    global mongo_client
+    if mongo_client is not None:
+        mongo_client.close()
+        mongo_client = None
+
+
+def mongo_stats():
+    if mongo_client is None:
+        return {}
+    stats = mongo_pool_stats.as_dict()
+    stats["max_pool_size"] = mongo_client.options.pool_options.max_pool_size
+    stats["min_pool_size"] = mongo_client.options.pool_options.min_pool_size
+    return stats
+
+
+# Used as a dependency by the routes that read from Mongo, for example
+#   def get_category(category_id: int, db=Depends(get_mongo_db)):
+def get_mongo_db():
+    return mongo_client[mongo_dbname]
+
+
+# The async versions of the PostgreSQL pool and Mongo client, only opened
+# when API_MODE is "async". They must be created inside the event loop so
+# they are opened from the startup event.
+async_pool = None
+async_mongo_client = None
+_async_checker = None
+
+
+async def open_async():
+    global async_pool, async_mongo_client, _async_checker
+    if async_pool is None:
+        min_size = _env_int("PGPOOL_MIN_SIZE", 2)
+        async_pool = AsyncConnectionPool(
+            "",
+            name="trivia-game-async",
+            min_size=min_size,
+            max_size=_env_int("PGPOOL_MAX_SIZE", max(min_size, 10)),
+            max_lifetime=_env_float("PGPOOL_MAX_LIFETIME", 3600),
+            max_idle=_env_float("PGPOOL_MAX_IDLE", 600),
+            timeout=_env_float("PGPOOL_TIMEOUT", 5),
+            configure=metrics.timed_async_connection,
+        )
+        interval = _env_float("PGPOOL_CHECK_INTERVAL", 60)
+        if interval > 0:
+            _async_checker = asyncio.create_task(_check_async_pool(interval))
+    if async_mongo_client is None:
+        # only needed in async mode, and slow to import
+        import motor.motor_asyncio
+
+        # Uses the same settings as open_mongo
+        open_mongo()
+        options = mongo_client.options.pool_options
+        async_mongo_client = motor.motor_asyncio.AsyncIOMotorClient(
+            _mongo_url(),
+            maxPoolSize=options.max_pool_size,
+            minPoolSize=options.min_pool_size,
+            serverSelectionTimeoutMS=_env_int("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+            waitQueueTimeoutMS=_env_int("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000),
+            event_listeners=[mongo_pool_stats, metrics.mongo_listener],
+        )
+
+
+async def close_async():
+    global async_pool, async_mongo_client, _async_checker
+    if _async_checker is not None:
+        _async_checker.cancel()
+        _async_checker = None
+    if async_mongo_client is not None:
+        async_mongo_client.close()
+        async_mongo_client = None
+    if async_pool is not None:
+        await async_pool.close()
+        async_pool = None
+
+
+async def _check_async_pool(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await async_pool.check()
+        except Exception:
+            pass
+
+
+def async_pool_stats():
+    if async_pool is None:
+        return {}
+    return async_pool.get_stats()
+
+
+@asynccontextmanager
+async def async_connection():
+    global pool_timeouts
+    started = time.perf_counter()
+    try:
+        async with async_pool.connection() as conn:
+            metrics.record_pool_wait("async", time.perf_counter() - started)
+            yield conn
+    except PoolTimeout:
+        pool_timeouts += 1
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Database is busy, try again later",
+        )
+
+
+# The async versions of get_conn and get_mongo_db
+async def get_async_conn():
+    async with async_connection() as conn:
+        yield conn
+
+
+def get_async_mongo_db():
+    return async_mongo_client[mongo_dbname]
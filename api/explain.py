@@ -0,0 +1,170 @@
+# Checks that the queries of the routes use indexes. Each query is run
+# with EXPLAIN (which plans it without running it, so the UPDATEs change
+# nothing) and the check fails when the plan reads a whole table with a
+# sequential scan and that table has more than EXPLAIN_MAX_SEQ_ROWS rows.
+# Small tables are fine to scan, PostgreSQL rightly prefers it.
+#
+# The Mongo queries of the category routes are checked the same way, a
+# COLLSCAN of a big collection fails.
+#
+# The indexes themselves are created by the migrations in schema.py. Run
+# from the api directory after loading the data:
+#   python -m explain
+#   python -m explain --max-seq-rows 1000
+import argparse
+import json
+import os
+import sys
+import psycopg
+import board_store
+import db
+import game_pool
+import invalidations
+import sampler
+from pagination import encode_cursor
+from routers.categories import categories_page_pipeline, categories_page_query
+from routers.clues import CLUE_QUERY, CLUE_VERSION_QUERY, clue_search_query, clues_by_id_query, clues_page_query
+from routers.games import GAME_QUERY, games_page_query
+
+MAX_SEQ_ROWS = int(os.environ.get("EXPLAIN_MAX_SEQ_ROWS", 10000))
+
+
+# (name, sql, params) of the queries to check. Queries that read a whole
+# table on purpose, like the exports, ORDER BY RANDOM() fallbacks and
+# loading every clue id into the all_clues sampler, are left out.
+def queries():
+    return [
+        ("clues page", *clues_page_query(10, None)),
+        ("clues page after", *clues_page_query(0, encode_cursor(1000))),
+        ("clues by id", *clues_by_id_query([1, 2, 3])),
+        ("clue search", *clue_search_query("river capital", False, None)),
+        ("clue search fuzzy", *clue_search_query("missisippi", True, None)),
+        ("clue", CLUE_QUERY, [1]),
+        ("clue version", CLUE_VERSION_QUERY, [1]),
+        ("sampled clues", sampler.valid_clues._select_sql(), [[1, 2, 3]]),
+        (
+            "valid clue ids",
+            f"SELECT clues.id FROM clues WHERE {sampler.valid_clues.where} ORDER BY clues.id",
+            [],
+        ),
+        (
+            "canon clue ids",
+            f"SELECT clues.id FROM clues WHERE {sampler.canon_clues.where} ORDER BY clues.id",
+            [],
+        ),
+        ("invalidate clue", invalidations.INVALIDATE_CLUE, [1]),
+        ("add votes", invalidations.ADD_VOTES, [[1, 2], [1, 1]]),
+        ("categories page", *categories_page_query(10, None)),
+        ("categories page after", *categories_page_query(0, ("M", 1))),
+        ("games page", *games_page_query(10, None)),
+        ("games page after", *games_page_query(0, encode_cursor(1000))),
+        ("game", GAME_QUERY, [1]),
+        ("claim custom game", game_pool.CLAIM_GAME_DEFINITION, []),
+        ("board clues", game_pool.CATEGORY_CLUES, [[1, 2, 3, 4, 5, 6]]),
+        ("board", board_store.GET_BOARD, [1]),
+        ("playable boards", board_store.PLAYABLE_RANGE, []),
+        # one LATERAL index lookup per random start id
+        ("random boards", board_store.RANDOM_BOARDS, [[1, 500, 1000, 5000, 10000, 20000]]),
+    ]
+
+
+def seq_scans(plan):
+    # Every table read with a sequential scan anywhere in the plan
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan["Relation Name"]
+    for child in plan.get("Plans", []):
+        yield from seq_scans(child)
+
+
+def table_rows(conn, table):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)",
+            [table],
+        )
+        row = cur.fetchone()
+        return row[0] if row is not None else 0
+
+
+def check_postgres(conn, max_seq_rows):
+    failures = []
+    for name, sql, params in queries():
+        with conn.cursor() as cur:
+            cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cur.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        # Planning an UPDATE locks its table, roll back so the lock is not
+        # held while the other queries are checked
+        conn.rollback()
+        for table in sorted(set(seq_scans(plan[0]["Plan"]))):
+            rows = table_rows(conn, table)
+            if rows > max_seq_rows:
+                failures.append(f"{name}: sequential scan of {table} ({rows} rows)")
+    return failures
+
+
+def collection_scans(plan):
+    # Every COLLSCAN stage anywhere in a Mongo explain output
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            yield plan
+        for value in plan.values():
+            yield from collection_scans(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from collection_scans(value)
+
+
+def check_mongo(mongo_db, max_seq_rows):
+    failures = []
+    checks = [
+        (
+            "categories page",
+            "categories",
+            {"aggregate": "categories", "pipeline": categories_page_pipeline(10, None), "cursor": {}},
+        ),
+        (
+            "categories page after",
+            "categories",
+            {"aggregate": "categories", "pipeline": categories_page_pipeline(0, ("M", 1)), "cursor": {}},
+        ),
+        # what the $lookup of the categories page runs for every category
+        (
+            "clues of a category",
+            "clues",
+            {"find": "clues", "filter": {"category_id": 1}},
+        ),
+    ]
+    for name, collection, command in checks:
+        plan = mongo_db.command({"explain": command, "verbosity": "queryPlanner"})
+        if any(True for _ in collection_scans(plan)):
+            rows = mongo_db[collection].estimated_document_count()
+            if rows > max_seq_rows:
+                failures.append(f"{name}: collection scan of {collection} ({rows} documents)")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-seq-rows", type=int, default=MAX_SEQ_ROWS)
+    parser.add_argument("--no-mongo", action="store_true")
+    args = parser.parse_args()
+
+    with psycopg.connect() as conn:
+        failures = check_postgres(conn, args.max_seq_rows)
+    if not args.no_mongo:
+        mongo_db = db.open_mongo()[db.mongo_dbname]
+        failures += check_mongo(mongo_db, args.max_seq_rows)
+        db.close_mongo()
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        print(f"{len(failures)} queries read big tables without an index")
+        sys.exit(1)
+    print("all queries use indexes")
+
+
+if __name__ == "__main__":
+    main()
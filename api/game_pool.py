@@ -0,0 +1,373 @@
+import os
+import threading
+import time
+import sampler
+from sampler import CLUE_COLUMNS, MAX_RETRIES
+
+
+# Building a custom game board means picking the clues and writing the
+# game definition with all of its clues, which is slow to do while the
+# player waits for POST /api/custom-games. Instead a background thread
+# keeps GAME_POOL_SIZE finished boards in the game_definitions table,
+# marked as pooled, and the route just claims one of them.
+#
+# The claim locks the oldest pooled board with FOR UPDATE SKIP LOCKED, so
+# requests (and server processes) running at the same time each get a
+# different board without waiting on each other. When the pool is empty
+# the route builds a board itself like before.
+#
+# GAME_LAYOUT picks how the clues of a board are chosen: "random" takes
+# CUSTOM_GAME_SIZE random canon clues, "balanced" makes a real board of
+# BOARD_CATEGORIES categories with one clue for each of BOARD_VALUES values.
+
+GAME_LAYOUT = os.environ.get("GAME_LAYOUT", "random")
+
+# How many clues go on a random custom game board
+CUSTOM_GAME_SIZE = int(os.environ.get("CUSTOM_GAME_SIZE", 30))
+
+# The size of a balanced board
+BOARD_CATEGORIES = int(os.environ.get("BOARD_CATEGORIES", 6))
+BOARD_VALUES = int(os.environ.get("BOARD_VALUES", 5))
+
+# How many boards to keep ready, 0 turns the pool off
+GAME_POOL_SIZE = int(os.environ.get("GAME_POOL_SIZE", 20))
+
+# Only one server process refills the pool at a time, see GamePool.refill.
+# schema.py uses 7216001 for the migrations.
+REFILL_LOCK_ID = 7216002
+
+
+# One statement creates the game definition and links all of its
+# clues, so it is one round trip however big the board is, and it
+# runs atomically without needing its own transaction.
+# unnest turns the array of clue ids into one row per clue, WITH
+# ORDINALITY numbers them so the board keeps its order.
+# Uses the RETURNING clause to get the data
+# just inserted into the database. See
+# https://www.postgresql.org/docs/current/sql-insert.html
+CREATE_GAME_DEFINITION = """
+    WITH game_def AS (
+        INSERT INTO game_definitions (created_on, pooled)
+        VALUES (CURRENT_TIMESTAMP, %s)
+        RETURNING id, created_on
+    ), linked AS (
+        INSERT INTO game_definition_clues
+            (game_definition_id, clue_id, position)
+        SELECT game_def.id, clue_ids.clue_id, clue_ids.position
+        FROM game_def,
+            unnest(%s::integer[]) WITH ORDINALITY AS clue_ids(clue_id, position)
+    )
+    SELECT id, created_on FROM game_def
+"""
+
+# Takes the oldest board out of the pool and returns its clues in board
+# order, one row per clue starting with the game id and created_on.
+# SKIP LOCKED passes over boards another request is claiming right now.
+# No rows means the pool is empty.
+CLAIM_GAME_DEFINITION = f"""
+    WITH claimed AS (
+        UPDATE game_definitions
+        SET pooled = false, created_on = CURRENT_TIMESTAMP
+        WHERE id = (
+            SELECT id
+            FROM game_definitions
+            WHERE pooled
+            ORDER BY id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, created_on
+    )
+    SELECT claimed.id, claimed.created_on, {CLUE_COLUMNS}
+    FROM claimed
+        INNER JOIN game_definition_clues
+        ON (game_definition_clues.game_definition_id = claimed.id)
+        INNER JOIN clues
+        ON (clues.id = game_definition_clues.clue_id)
+        INNER JOIN categories
+        ON (clues.category_id = categories.id)
+    ORDER BY game_definition_clues.position
+"""
+
+# Used while the sampler is still loading right after startup
+RANDOM_CLUES = f"""
+    SELECT {CLUE_COLUMNS}
+    FROM categories
+        INNER JOIN clues
+        ON (clues.category_id = categories.id)
+    WHERE clues.canon IS true
+    ORDER BY RANDOM() LIMIT %s
+"""
+
+RANDOM_CATEGORIES = """
+    SELECT categories.id
+    FROM categories
+    WHERE categories.canon IS true
+    ORDER BY RANDOM() LIMIT %s
+"""
+
+# One random canon clue for every value of each of the categories,
+# ordered by category and then value
+CATEGORY_CLUES = f"""
+    SELECT DISTINCT ON (clues.category_id, clues.value) {CLUE_COLUMNS}
+    FROM categories
+        INNER JOIN clues
+        ON (clues.category_id = categories.id)
+    WHERE clues.category_id = ANY(%s)
+        AND clues.canon IS true
+        AND clues.value IS NOT NULL
+    ORDER BY clues.category_id, clues.value, RANDOM()
+"""
+
+
+def balanced_board(category_ids, rows):
+    # Keeps the categories that have enough different values, in the
+    # order they were picked, with their BOARD_VALUES lowest values
+    by_category = {}
+    for row in rows:
+        by_category.setdefault(row[0], []).append(row)
+    board = []
+    for category_id in category_ids:
+        clues = by_category.get(category_id, [])
+        if len(clues) >= BOARD_VALUES:
+            board.append(clues[:BOARD_VALUES])
+        if len(board) == BOARD_CATEGORIES:
+            break
+    return board
+
+
+def _new_ids(rows, seen):
+    # The category ids of the rows that were not tried yet, in order
+    ids = []
+    for row in rows:
+        if row[0] not in seen:
+            seen.add(row[0])
+            ids.append(row[0])
+    return ids
+
+
+def pick_clues(conn):
+    # Returns the rows of the clues of a new board, in board order
+    if GAME_LAYOUT == "balanced":
+        return _pick_balanced(conn)
+    with conn.cursor() as cur:
+        # Picks from the canon clue ids kept in memory, see sampler.py
+        clues = sampler.canon_clues.fetch(conn, CUSTOM_GAME_SIZE)
+        if clues is None:
+            cur.execute(RANDOM_CLUES, [CUSTOM_GAME_SIZE])
+            clues = cur.fetchall()
+        return clues
+
+
+def _pick_balanced(conn):
+    # Random clues give random categories, weighted towards categories
+    # with more clues. Twice as many as needed are tried because some
+    # categories don't have a clue for every value.
+    board = []
+    tried = []
+    seen = set()
+    with conn.cursor() as cur:
+        for _ in range(MAX_RETRIES):
+            wanted = (BOARD_CATEGORIES - len(board)) * 2
+            rows = sampler.canon_clues.fetch(conn, wanted)
+            if rows is None:
+                cur.execute(RANDOM_CATEGORIES, [wanted])
+                rows = cur.fetchall()
+            category_ids = _new_ids(rows, seen)
+            if not category_ids:
+                break
+            tried.extend(category_ids)
+            cur.execute(CATEGORY_CLUES, [category_ids])
+            board = balanced_board(tried, board_rows(board) + cur.fetchall())
+            if len(board) == BOARD_CATEGORIES:
+                break
+    return board_rows(board)
+
+
+async def pick_clues_async(conn):
+    # The same as pick_clues with an async connection
+    if GAME_LAYOUT == "balanced":
+        return await _pick_balanced_async(conn)
+    async with conn.cursor() as cur:
+        clues = await sampler.canon_clues.fetch_async(conn, CUSTOM_GAME_SIZE)
+        if clues is None:
+            await cur.execute(RANDOM_CLUES, [CUSTOM_GAME_SIZE])
+            clues = await cur.fetchall()
+        return clues
+
+
+async def _pick_balanced_async(conn):
+    board = []
+    tried = []
+    seen = set()
+    async with conn.cursor() as cur:
+        for _ in range(MAX_RETRIES):
+            wanted = (BOARD_CATEGORIES - len(board)) * 2
+            rows = await sampler.canon_clues.fetch_async(conn, wanted)
+            if rows is None:
+                await cur.execute(RANDOM_CATEGORIES, [wanted])
+                rows = await cur.fetchall()
+            category_ids = _new_ids(rows, seen)
+            if not category_ids:
+                break
+            tried.extend(category_ids)
+            await cur.execute(CATEGORY_CLUES, [category_ids])
+            found = await cur.fetchall()
+            board = balanced_board(tried, board_rows(board) + found)
+            if len(board) == BOARD_CATEGORIES:
+                break
+    return board_rows(board)
+
+
+def board_rows(board):
+    return [row for clues in board for row in clues]
+
+
+def create_game(conn, clues, pooled=False):
+    with conn.cursor() as cur:
+        cur.execute(CREATE_GAME_DEFINITION, [pooled, [clue[3] for clue in clues]])
+        return cur.fetchone()
+
+
+class GamePool:
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        # boards in the pool the last time it was counted, less the ones
+        # claimed by this process since
+        self.depth = 0
+        self.claimed = 0
+        self.empty = 0
+        self.generated = 0
+        self.refills = 0
+        self.last_refill_seconds = 0.0
+        self.last_refill_rate = 0.0
+        # set when a board is claimed so the pool is refilled right away
+        self.wanted = threading.Event()
+
+    def claim(self, conn):
+        # Returns (id, created_on, clue rows) of a pooled board, or None
+        if self.size <= 0:
+            return None
+        with conn.cursor() as cur:
+            cur.execute(CLAIM_GAME_DEFINITION)
+            rows = cur.fetchall()
+        return self._claimed(rows)
+
+    async def claim_async(self, conn):
+        if self.size <= 0:
+            return None
+        async with conn.cursor() as cur:
+            await cur.execute(CLAIM_GAME_DEFINITION)
+            rows = await cur.fetchall()
+        return self._claimed(rows)
+
+    def _claimed(self, rows):
+        with self.lock:
+            if not rows:
+                self.empty += 1
+                self.depth = 0
+            else:
+                self.claimed += 1
+                self.depth = max(self.depth - 1, 0)
+        self.wanted.set()
+        if not rows:
+            return None
+        return rows[0][0], rows[0][1], [row[2:] for row in rows]
+
+    def refill(self, pool):
+        # Adds boards until there are size of them, each in its own
+        # transaction so a claim can take one as soon as it is ready.
+        # Every server process runs this, so the pool is counted and filled
+        # while holding a lock, or each of them would add size - depth
+        # boards. It is a session lock, so it stays across the transactions
+        # and the refill needs only the one connection (a gunicorn worker
+        # may have a pool of one, see PGPOOL_TOTAL_SIZE in gunicorn.conf.py).
+        # It goes away with the connection if the process dies. A process
+        # that does not get the lock leaves the refill to the one that has it.
+        started = time.monotonic()
+        generated = 0
+        with pool.connection() as conn:
+            locked = conn.execute(
+                "SELECT pg_try_advisory_lock(%s)", [REFILL_LOCK_ID]
+            ).fetchone()[0]
+            depth = conn.execute(
+                "SELECT COUNT(*) FROM game_definitions WHERE pooled"
+            ).fetchone()[0]
+            conn.commit()
+            try:
+                while (
+                    locked
+                    and depth + generated < self.size
+                    and not _generator_stop.is_set()
+                ):
+                    with conn.transaction():
+                        clues = pick_clues(conn)
+                        if not clues:
+                            break
+                        create_game(conn, clues, pooled=True)
+                    generated += 1
+            finally:
+                if locked:
+                    conn.execute("SELECT pg_advisory_unlock(%s)", [REFILL_LOCK_ID])
+        elapsed = time.monotonic() - started
+        with self.lock:
+            self.depth = depth + generated
+            self.generated += generated
+            if generated:
+                self.refills += 1
+                self.last_refill_seconds = elapsed
+                self.last_refill_rate = generated / elapsed
+
+    def stats(self):
+        with self.lock:
+            return {
+                "layout": GAME_LAYOUT,
+                "size": self.size,
+                "depth": self.depth,
+                "claimed": self.claimed,
+                "empty": self.empty,
+                "generated": self.generated,
+                "refills": self.refills,
+                "last_refill_seconds": self.last_refill_seconds,
+                # boards per second during the last refill
+                "last_refill_rate": self.last_refill_rate,
+            }
+
+
+games = GamePool(GAME_POOL_SIZE)
+
+_generator = None
+_generator_stop = threading.Event()
+
+
+def start(pool):
+    # Keeps the pool filled in a background thread
+    global _generator
+    if games.size <= 0:
+        return
+    _generator_stop.clear()
+    _generator = threading.Thread(target=_generate, args=(pool,), daemon=True)
+    _generator.start()
+
+
+def stop():
+    global _generator
+    _generator_stop.set()
+    games.wanted.set()
+    if _generator is not None:
+        _generator.join()
+        _generator = None
+
+
+def _generate(pool):
+    interval = float(os.environ.get("GAME_POOL_REFILL_INTERVAL", 10))
+    while not _generator_stop.is_set():
+        games.wanted.clear()
+        try:
+            games.refill(pool)
+        except Exception:
+            # the database may be down, try again on the next round
+            pass
+        # wakes up early when a board is claimed
+        games.wanted.wait(interval)
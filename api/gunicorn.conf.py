@@ -0,0 +1,99 @@
+# The production server: gunicorn starts one uvicorn worker process per
+# core, so requests are spread over every core of the machine instead of
+# the single process (and --reload file watcher) of Dockerfile.dev.
+#   gunicorn main:app
+# reads this file by itself when run from the api directory, see
+# Dockerfile for the image.
+#
+# How it starts:
+#   1. main.py is imported once here in the master (preload_app), before
+#      the workers are forked, so each worker starts with the code already
+#      loaded instead of importing everything again. Nothing at import time
+#      may open a connection or start a thread, a forked worker would share
+#      the socket or lose the thread (see post_fork below).
+#   2. The migrations and Mongo indexes run once in the master (on_starting)
+#      instead of in every worker.
+#   3. Each worker opens its own PostgreSQL pool, Mongo client and
+#      background threads in the startup event of main.py, after the fork.
+#
+# On SIGTERM the workers stop accepting connections, finish the requests
+# they have for up to GRACEFUL_TIMEOUT seconds and then run the shutdown
+# event of main.py, which flushes the buffered votes and closes the pools.
+#
+# Things to know with more than one worker:
+#   - each worker has its own pool, so PostgreSQL sees workers times
+#     PGPOOL_MAX_SIZE connections. Set PGPOOL_TOTAL_SIZE to split a total
+#     between the workers instead.
+#   - the "memory" cache is per worker, and a change only forgets the
+#     copies in the worker that made it. Use CACHE_BACKEND=redis so the
+#     workers share one cache (see cache.py).
+#   - the "memory" rate limits are per worker too, so a client gets the
+#     rate once per worker. RATE_LIMIT_BACKEND=redis shares them (see
+#     ratelimit.py).
+#   - /metrics and /api/health report the worker that answered.
+import multiprocessing
+import os
+
+# WEB_CONCURRENCY is the usual name for this on hosting platforms
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+
+preload_app = True
+
+# seconds a worker gets to finish its requests after SIGTERM
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+# a worker that does not check in with the master for this long is
+# restarted
+timeout = int(os.environ.get("WORKER_TIMEOUT", 60))
+# seconds an idle client connection is kept open. Behind a load balancer
+# set this above the balancer's own idle timeout, so it never sends a
+# request on a connection the worker just closed
+keepalive = int(os.environ.get("KEEPALIVE", 5))
+
+# restarts a worker after this many requests (0 never does), the jitter
+# keeps them from all restarting at once
+max_requests = int(os.environ.get("MAX_REQUESTS", 0))
+max_requests_jitter = int(os.environ.get("MAX_REQUESTS_JITTER", 0))
+
+accesslog = os.environ.get("ACCESS_LOG", "-")
+errorlog = "-"
+loglevel = os.environ.get("LOG_LEVEL", "info")
+
+# Splits PGPOOL_TOTAL_SIZE connections between the workers. db.py reads
+# PGPOOL_MAX_SIZE when a worker opens its pool, after this has run. Set
+# the number of workers with WEB_CONCURRENCY rather than --workers, this
+# runs before the command line is read.
+if "PGPOOL_TOTAL_SIZE" in os.environ:
+    per_worker = max(1, int(os.environ["PGPOOL_TOTAL_SIZE"]) // workers)
+    os.environ["PGPOOL_MAX_SIZE"] = str(per_worker)
+    os.environ["PGPOOL_MIN_SIZE"] = str(
+        min(per_worker, int(os.environ.get("PGPOOL_MIN_SIZE", 2)))
+    )
+
+
+def on_starting(server):
+    # Runs in the master before the workers are forked. The app is already
+    # imported (preload_app), so turning MIGRATE_ON_STARTUP off here is
+    # what every worker sees.
+    import schema
+
+    if schema.MIGRATE_ON_STARTUP:
+        server.log.info("Running migrations")
+        schema.migrate_all()
+        schema.MIGRATE_ON_STARTUP = False
+
+
+def post_fork(server, worker):
+    # The pools are opened by the startup event in each worker. One that
+    # was already open in the master would now be shared by every worker
+    # through the same sockets.
+    import db
+
+    if db.pool is not None or db.mongo_client is not None:
+        raise RuntimeError("a connection was opened before the workers were forked")
+    server.log.info("Worker %s started", worker.pid)
+
+
+def worker_exit(server, worker):
+    server.log.info("Worker %s stopped", worker.pid)
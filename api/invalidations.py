@@ -0,0 +1,132 @@
+import os
+import threading
+from sampler import CLUE_COLUMNS
+
+
+# "Report bad clue" votes, from DELETE /api/clues/{clue_id}.
+#
+# In the default "immediate" mode every vote is its own UPDATE. During a
+# live game lots of players may report the same clue at once, and each
+# of those UPDATEs has to wait for the row lock of the one before it.
+# With INVALIDATION_MODE=buffered the votes are instead added up in memory
+# and written every INVALIDATION_FLUSH_MS milliseconds with one UPDATE for
+# all the clues that got votes, so a flood of votes for one clue becomes a
+# single write.
+
+MODE = os.environ.get("INVALIDATION_MODE", "immediate")
+
+# Adds one vote and returns the clue with its category, in one statement.
+# The updated row is joined as "clues" so the usual CLUE_COLUMNS can be
+# selected from it.
+INVALIDATE_CLUE = f"""
+    WITH changed_clues AS (
+        UPDATE clues
+        SET invalid_count = invalid_count + 1
+        WHERE id = %s
+        RETURNING *
+    )
+    SELECT {CLUE_COLUMNS}
+    FROM categories
+        INNER JOIN changed_clues AS clues
+        ON (clues.category_id = categories.id)
+"""
+
+# Adds many votes at once. The two arrays are the clue ids and how many
+# votes each one got.
+ADD_VOTES = """
+    UPDATE clues
+    SET invalid_count = clues.invalid_count + votes.count
+    FROM unnest(%s::integer[], %s::integer[]) AS votes(id, count)
+    WHERE clues.id = votes.id
+"""
+
+
+class VoteBuffer:
+    def __init__(self):
+        self.votes = {}
+        self.lock = threading.Lock()
+        self.flushes = 0
+        self.flushed_votes = 0
+
+    def add(self, clue_id):
+        # Returns how many votes are waiting for this clue, this one included
+        with self.lock:
+            self.votes[clue_id] = self.votes.get(clue_id, 0) + 1
+            return self.votes[clue_id]
+
+    def pending(self, clue_id):
+        with self.lock:
+            return self.votes.get(clue_id, 0)
+
+    def flush(self, pool, on_flushed=None):
+        with self.lock:
+            votes = self.votes
+            self.votes = {}
+        if not votes:
+            return
+        # Sorted so that two processes flushing at the same time lock the
+        # rows in the same order and can't deadlock
+        clue_ids = sorted(votes)
+        try:
+            with pool.connection() as conn:
+                conn.execute(ADD_VOTES, [clue_ids, [votes[id] for id in clue_ids]])
+        except Exception:
+            # put the votes back so they are written on the next flush
+            with self.lock:
+                for clue_id, count in votes.items():
+                    self.votes[clue_id] = self.votes.get(clue_id, 0) + count
+            raise
+        self.flushes += 1
+        self.flushed_votes += sum(votes.values())
+        if on_flushed is not None:
+            on_flushed(clue_ids)
+
+    def stats(self):
+        with self.lock:
+            waiting = sum(self.votes.values())
+        return {
+            "mode": MODE,
+            "waiting_votes": waiting,
+            "flushes": self.flushes,
+            "flushed_votes": self.flushed_votes,
+        }
+
+
+buffer = VoteBuffer()
+
+_flusher = None
+_flusher_stop = threading.Event()
+
+
+def start(pool, on_flushed=None):
+    # Writes the buffered votes in a background thread, only in buffered mode
+    global _flusher
+    if MODE != "buffered":
+        return
+    interval = float(os.environ.get("INVALIDATION_FLUSH_MS", 200)) / 1000
+    _flusher_stop.clear()
+    _flusher = threading.Thread(
+        target=_flush_loop,
+        args=(pool, interval, on_flushed),
+        daemon=True,
+    )
+    _flusher.start()
+
+
+def stop(pool, on_flushed=None):
+    global _flusher
+    _flusher_stop.set()
+    if _flusher is not None:
+        _flusher.join()
+        _flusher = None
+        # write whatever came in since the last flush
+        buffer.flush(pool, on_flushed)
+
+
+def _flush_loop(pool, interval, on_flushed):
+    while not _flusher_stop.wait(interval):
+        try:
+            buffer.flush(pool, on_flushed)
+        except Exception:
+            # the database may be down, the votes are kept for next time
+            pass
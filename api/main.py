@@ -1,13 +1,92 @@
-from fastapi import FastAPI
+from fastapi import APIRouter, FastAPI
+import board_store
+import category_sync
+import db
+import game_pool
+import invalidations
+import metrics
+import sampler
+import schema
+from routers import boards
 from routers import categories
 from routers import clues
 from routers import games
+from routers import export
+from routers import health
 
 
 app = FastAPI()
 
+# Times every request, see metrics.py
+app.middleware("http")(metrics.middleware)
+
+
+# The PostgreSQL pool and the MongoClient are created once when the server
+# starts and shared by every request, see db.py
+@app.on_event("startup")
+async def startup():
+    db.open_pool()
+    if schema.MIGRATE_ON_STARTUP:
+        with db.pool.connection() as conn:
+            schema.migrate(conn)
+    db.open_mongo()
+    if db.API_MODE == "async":
+        await db.open_async()
+    sampler.start(db.pool)
+    game_pool.start(db.pool)
+    board_store.start(db.pool)
+    invalidations.start(db.pool, clues.forget_clues)
+    category_sync.start(db.pool, db.get_mongo_db(), categories.forget_categories)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    category_sync.stop()
+    board_store.stop()
+    game_pool.stop()
+    sampler.stop()
+    invalidations.stop(db.pool, clues.forget_clues)
+    await db.close_async()
+    db.close_mongo()
+    db.close_pool()
+
+
+# Keeps the routes of sync_router in the same order, but uses the route
+# from async_router instead when it has one for the same path and methods
+def with_async_routes(sync_router, async_router):
+    async_routes = {
+        (route.path, frozenset(route.methods)): route
+        for route in async_router.routes
+    }
+    router = APIRouter()
+    router.routes = [
+        async_routes.get((route.path, frozenset(route.methods)), route)
+        for route in sync_router.routes
+    ]
+    return router
+
+
+routers = [categories.router, clues.router, games.router, boards.router]
+
 # Using routers for organization
 # See https://fastapi.tiangolo.com/tutorial/bigger-applications/
-app.include_router(categories.router)
-app.include_router(clues.router)
-app.include_router(games.router)
\ No newline at end of file
+if db.API_MODE == "async":
+    # only imported when used, which keeps motor out of a sync server
+    from routers import async_boards
+    from routers import async_categories
+    from routers import async_clues
+    from routers import async_games
+
+    async_routers = [
+        async_categories.router,
+        async_clues.router,
+        async_games.router,
+        async_boards.router,
+    ]
+    for sync_router, async_router in zip(routers, async_routers):
+        app.include_router(with_async_routes(sync_router, async_router))
+else:
+    for sync_router in routers:
+        app.include_router(sync_router)
+app.include_router(export.router)
+app.include_router(health.router)
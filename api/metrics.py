@@ -0,0 +1,306 @@
+import contextvars
+import os
+import re
+import threading
+import time
+import psycopg
+from pymongo import monitoring
+
+
+# Timing of requests, queries and Mongo commands, so we can see where the
+# time goes. Everything is kept in memory in this process and sent in the
+# Prometheus text format by GET /metrics (see routers/health.py).
+#
+# - middleware times every request, labelled by the route's path
+# - TimedCursor and AsyncTimedCursor time every PostgreSQL query; db.py
+#   makes them the cursor class of every pooled connection, so the routers
+#   don't have to do anything
+# - MongoCommands times every Mongo command, it is an event listener of
+#   the MongoClient
+# - db.connection() reports how long it waited for a pooled connection
+#
+# The queries and commands of a request are also added up per request, so
+# a route that runs a query per row shows up as lots of queries per
+# request. With METRICS_SERVER_TIMING=1 those totals are also sent back in
+# a Server-Timing header, which browser dev tools show for each request.
+
+SERVER_TIMING = os.environ.get("METRICS_SERVER_TIMING", "0") == "1"
+
+# Upper bounds of the histogram buckets, in seconds
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# For counts of things per request
+COUNTS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets=SECONDS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., count, sum]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {key: list(values) for key, values in self.series.items()}
+        for label_values, values in sorted(series.items()):
+            labels = _labels(self.labels, label_values)
+            for bound, count in zip(self.buckets, values):
+                bucket = _labels(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{bucket} {count}")
+            bucket = _labels(self.labels + ("le",), label_values + ("+Inf",))
+            lines.append(f"{self.name}_bucket{bucket} {values[-2]}")
+            lines.append(f"{self.name}_count{labels} {values[-2]}")
+            lines.append(f"{self.name}_sum{labels} {values[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount, *label_values):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            series = dict(self.series)
+        for label_values, value in sorted(series.items()):
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+requests = Counter(
+    "trivia_requests_total", "Requests by route and status", ("route", "method", "status")
+)
+request_seconds = Histogram(
+    "trivia_request_seconds",
+    "Time until the response headers are sent",
+    ("route", "method"),
+)
+request_queries = Histogram(
+    "trivia_request_queries",
+    "PostgreSQL queries per request",
+    ("route",),
+    buckets=COUNTS,
+)
+request_mongo_commands = Histogram(
+    "trivia_request_mongo_commands",
+    "Mongo commands per request",
+    ("route",),
+    buckets=COUNTS,
+)
+query_seconds = Histogram(
+    "trivia_query_seconds", "PostgreSQL query time", ("query",)
+)
+query_rows = Counter(
+    "trivia_query_rows_total", "Rows returned or changed by queries", ("query",)
+)
+pool_wait_seconds = Histogram(
+    "trivia_pool_wait_seconds", "Time waiting for a pooled connection", ("pool",)
+)
+mongo_commands = Counter(
+    "trivia_mongo_commands_total", "Mongo commands", ("command", "ok")
+)
+mongo_command_seconds = Histogram(
+    "trivia_mongo_command_seconds", "Mongo command time", ("command",)
+)
+
+collectors = [
+    requests,
+    request_seconds,
+    request_queries,
+    request_mongo_commands,
+    query_seconds,
+    query_rows,
+    pool_wait_seconds,
+    mongo_commands,
+    mongo_command_seconds,
+]
+
+
+def render(gauges=None):
+    # gauges are extra values to report, {name: {label value: number}},
+    # for example the pool stats from db.pool_stats()
+    lines = []
+    for collector in collectors:
+        lines.extend(collector.render())
+    for name, values in (gauges or {}).items():
+        lines.append(f"# TYPE {name} gauge")
+        for stat, value in sorted(values.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f'{name}{{stat="{stat}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+# The totals of the request being handled. Sync routes run in another
+# thread, but with a copy of this context, so they add to the same dict.
+_current = contextvars.ContextVar("metrics_current", default=None)
+
+
+def _add(name, seconds, count=1):
+    current = _current.get()
+    if current is not None:
+        current[name] += seconds
+        current[name + "_count"] += count
+
+
+# "SELECT categories", "UPDATE clues", ... Queries are labelled with their
+# first word and first table so the number of labels stays small.
+_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", re.IGNORECASE)
+
+
+def query_label(query):
+    if not isinstance(query, str):
+        # a psycopg.sql.Composed, still mostly plain text
+        query = str(query)
+    words = query.split(None, 1)
+    if not words:
+        return "empty"
+    label = words[0].upper()
+    table = _TABLE.search(query)
+    if table is not None:
+        label += " " + table.group(1)
+    return label
+
+
+def record_query(query, seconds, rows):
+    label = query_label(query)
+    query_seconds.observe(seconds, label)
+    if rows is not None and rows > 0:
+        query_rows.inc(rows, label)
+    _add("db", seconds)
+
+
+def record_pool_wait(pool, seconds):
+    pool_wait_seconds.observe(seconds, pool)
+    _add("pool", seconds)
+
+
+class TimedCursor(psycopg.Cursor):
+    def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            record_query(query, time.perf_counter() - started, self.rowcount)
+
+
+class AsyncTimedCursor(psycopg.AsyncCursor):
+    async def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            record_query(query, time.perf_counter() - started, self.rowcount)
+
+
+def timed_connection(conn):
+    # Passed as configure= to the pools in db.py, runs on each new connection
+    conn.cursor_factory = TimedCursor
+
+
+async def timed_async_connection(conn):
+    conn.cursor_factory = AsyncTimedCursor
+
+
+class MongoCommands(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event, "true")
+
+    def failed(self, event):
+        self._record(event, "false")
+
+    def _record(self, event, ok):
+        seconds = event.duration_micros / 1000000
+        mongo_commands.inc(1, event.command_name, ok)
+        mongo_command_seconds.observe(seconds, event.command_name)
+        # motor runs commands in its own threads, so in async mode they
+        # are not added to the request's totals
+        _add("mongo", seconds)
+
+
+mongo_listener = MongoCommands()
+
+
+# The path of each route by its endpoint, like "/api/clue/{clue_id}", so
+# requests for different ids are counted together
+_route_paths = {}
+
+
+def route_label(request):
+    endpoint = request.scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    path = _route_paths.get(endpoint)
+    if path is None:
+        for route in request.app.routes:
+            if getattr(route, "endpoint", None) is endpoint:
+                path = _route_paths[endpoint] = route.path
+                break
+        else:
+            path = endpoint.__name__
+    return path
+
+
+async def middleware(request, call_next):
+    current = {
+        "db": 0.0, "db_count": 0,
+        "pool": 0.0, "pool_count": 0,
+        "mongo": 0.0, "mongo_count": 0,
+    }
+    token = _current.set(current)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        _current.reset(token)
+    elapsed = time.perf_counter() - started
+
+    route = route_label(request)
+    requests.inc(1, route, request.method, response.status_code)
+    request_seconds.observe(elapsed, route, request.method)
+    request_queries.observe(current["db_count"], route)
+    request_mongo_commands.observe(current["mongo_count"], route)
+
+    if SERVER_TIMING:
+        response.headers["Server-Timing"] = ", ".join([
+            f'db;dur={current["db"] * 1000:.1f};desc="{current["db_count"]} queries"',
+            f'pool;dur={current["pool"] * 1000:.1f}',
+            f'mongo;dur={current["mongo"] * 1000:.1f};desc="{current["mongo_count"]} commands"',
+            f"total;dur={elapsed * 1000:.1f}",
+        ])
+    return response
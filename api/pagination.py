@@ -0,0 +1,36 @@
+import base64
+import json
+from fastapi import HTTPException, status
+
+
+# Keyset ("cursor") pagination. Instead of skipping over page * 100 rows,
+# which gets slower the deeper a client pages, a list response includes
+# a "next" cursor holding the sort key of the last row it returned. Passing
+# it back as ?after=... continues right after that row using the index.
+#
+# The cursor is just the sort key as JSON, base64 encoded so clients treat
+# it as an opaque string.
+
+def encode_cursor(*values):
+    raw = json.dumps(list(values), separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, *types):
+    # types are the expected type of each value in the cursor, for example
+    # decode_cursor(after, str, int) for a (title, id) cursor
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except ValueError:
+        values = None
+    if (
+        not isinstance(values, list)
+        or len(values) != len(types)
+        or not all(type(v) is t for v, t in zip(values, types))
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor",
+        )
+    return values
@@ -0,0 +1,207 @@
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from fastapi import HTTPException, Request, status
+
+
+# Token buckets for the routes that cost the most, so one client sending
+# requests as fast as it can gets 429s instead of taking all of the
+# database connections. Each client has a bucket of `burst` tokens per
+# route that fills up again at `rate` tokens a second, and every request
+# takes one. A route uses it as a dependency:
+#
+#   @router.get("/api/random-clue", dependencies=[Depends(ratelimit.random_clue)])
+#
+# A client is its IP address. Behind a proxy set
+# RATE_LIMIT_TRUST_FORWARDED=true so the address comes from X-Forwarded-For
+# instead of being the proxy's. RATE_LIMIT_API_KEYS is a comma separated
+# list of API keys that get a bucket of their own instead, when they are
+# sent in the X-API-Key header. Any other key is ignored, otherwise a
+# client could send a new made-up key with every request and always get a
+# full bucket.
+#
+# RATE_LIMIT_BACKEND picks where the buckets are kept, like cache.py:
+# "memory" (the default) is a dict in this process, so each gunicorn worker
+# counts on its own, "redis" keeps them at REDIS_URL so all workers share
+# them, and "none" turns the limits off. Anything with the same take()
+# can be put in limiter.backend instead.
+
+TRUST_FORWARDED = os.environ.get("RATE_LIMIT_TRUST_FORWARDED", "false") == "true"
+KEY_HEADER = os.environ.get("RATE_LIMIT_KEY_HEADER", "x-api-key")
+
+
+def _hash_key(api_key):
+    # the key itself is a secret, don't keep it around
+    return hashlib.blake2b(api_key.encode(), digest_size=16).hexdigest()
+
+
+API_KEYS = {
+    _hash_key(api_key.strip())
+    for api_key in os.environ.get("RATE_LIMIT_API_KEYS", "").split(",")
+    if api_key.strip()
+}
+
+
+class MemoryBackend:
+    def __init__(self, max_clients):
+        self.max_clients = max_clients
+        # key -> (tokens, updated)
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        # Returns (allowed, tokens left)
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            # forgetting the client seen longest ago gives it a full bucket,
+            # which only ever lets more through
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+            return allowed, tokens
+
+    def size(self):
+        return len(self.buckets)
+
+
+# The same as MemoryBackend.take, run inside Redis so two workers can't
+# both take the last token
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+-- a full bucket is the same as no bucket
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisBackend:
+    def __init__(self, url):
+        # only needed when RATE_LIMIT_BACKEND is "redis"
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.script = self.redis.register_script(TAKE_SCRIPT)
+
+    def take(self, key, rate, burst, now):
+        allowed, tokens = self.script(keys=[f"ratelimit:{key}"], args=[rate, burst, now])
+        return bool(allowed), float(tokens)
+
+    def size(self):
+        # counting the buckets would mean scanning the keys
+        return None
+
+
+class NoBackend:
+    def take(self, key, rate, burst, now):
+        return True, burst
+
+    def size(self):
+        return 0
+
+
+class Limiter:
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def take(self, key, rate, burst):
+        # Redis needs the same clock in every worker, so wall clock time
+        allowed, tokens = self.backend.take(key, rate, burst, time.time())
+        with self.lock:
+            if allowed:
+                self.allowed += 1
+            else:
+                self.limited += 1
+        return allowed, tokens
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backend": type(self.backend).__name__,
+                "clients": self.backend.size(),
+                "allowed": self.allowed,
+                "limited": self.limited,
+            }
+
+
+def client_key(request):
+    api_key = request.headers.get(KEY_HEADER)
+    if api_key:
+        hashed = _hash_key(api_key)
+        if hashed in API_KEYS:
+            return "key:" + hashed
+    if TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return "ip:" + forwarded.split(",")[0].strip()
+    if request.client is None:
+        return "ip:unknown"
+    return "ip:" + request.client.host
+
+
+class RateLimit:
+    # The dependency for one route. A rate of 0 turns the limit off.
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1.0, burst)
+
+    def __call__(self, request: Request):
+        if self.rate <= 0:
+            return
+        key = f"{self.name}:{client_key(request)}"
+        allowed, tokens = limiter.take(key, self.rate, self.burst)
+        if not allowed:
+            # seconds until the next token
+            retry_after = math.ceil((1 - tokens) / self.rate)
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests, try again later",
+                headers={"Retry-After": str(max(1, retry_after))},
+            )
+
+
+def _make_backend():
+    backend = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+    if backend == "redis":
+        return RedisBackend(os.environ.get("REDIS_URL", "redis://localhost:6379/0"))
+    if backend == "none":
+        return NoBackend()
+    return MemoryBackend(int(os.environ.get("RATE_LIMIT_MAX_CLIENTS", 100000)))
+
+
+def _limit(name, env, rate, burst):
+    return RateLimit(
+        name,
+        float(os.environ.get(f"RATE_LIMIT_{env}_RATE", rate)),
+        float(os.environ.get(f"RATE_LIMIT_{env}_BURST", burst)),
+    )
+
+
+limiter = Limiter(_make_backend())
+
+# requests a second and burst size of each limited route
+random_clue = _limit("random-clue", "RANDOM_CLUE", 10, 30)
+custom_games = _limit("custom-games", "CUSTOM_GAMES", 1, 10)
@@ -0,0 +1,37 @@
+from fastapi import APIRouter, Depends, Query, Request, status
+from db import get_async_conn
+from board_store import board_body, boards_body, store
+from rows import json_response
+from conditional import NO_STORE, content_etag, validated_response
+from .boards import MAX_BOARD_CATEGORIES, Board, Boards, Message
+
+# The async versions of the routes in boards.py, used when API_MODE is
+# "async" (see main.py)
+router = APIRouter()
+
+
+@router.get("/api/boards/random", response_model=Boards)
+async def random_boards(
+    categories: int = Query(6, ge=1, le=MAX_BOARD_CATEGORIES),
+    conn=Depends(get_async_conn),
+):
+    return json_response(
+        boards_body(await store.random_async(conn, categories)),
+        headers={"Cache-Control": NO_STORE},
+    )
+
+
+@router.get(
+    "/api/boards/{category_id}",
+    response_model=Board,
+    responses={404: {"model": Message}},
+)
+async def get_board(request: Request, category_id: int, conn=Depends(get_async_conn)):
+    board = await store.get_async(conn, category_id)
+    if board is None:
+        return json_response(
+            {"message": "Category not found"},
+            status.HTTP_404_NOT_FOUND,
+        )
+    body = board_body(board)
+    return validated_response(request, body, content_etag(body))
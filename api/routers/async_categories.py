@@ -0,0 +1,254 @@
+from fastapi import APIRouter, Depends, Request, Response, status
+from typing import Optional
+import psycopg
+from batch import IdsIn, check_ids, parse_ids
+from cache import cache
+from counts import counts
+from rows import encode, json_response
+from singleflight import flights
+from conditional import page_response
+from db import async_connection, get_async_conn, get_async_mongo_db
+from pagination import decode_cursor
+from .categories import (
+    CATEGORIES_BACKEND,
+    CATEGORY_FIELDS,
+    Categories,
+    CategoryBatch,
+    CategoryIn,
+    CategoryOut,
+    Message,
+    categories_page,
+    category_batch,
+    category_body,
+    category_cache_value,
+    category_response,
+    categories_page_pipeline,
+    categories_page_query,
+    forget_category,
+)
+
+# The async versions of the routes in categories.py, used when API_MODE
+# is "async" (see main.py). They run the same queries, but wait for the
+# database without holding on to a thread.
+router = APIRouter()
+
+
+@router.get("/api/categories/{page}", response_model=Categories)
+async def categories_list(
+    request: Request,
+    page: int = 0,
+    after: Optional[str] = None,
+    exact: bool = False,
+    db=Depends(get_async_mongo_db),
+):
+    after_key = None
+    if after is not None:
+        after_key = decode_cursor(after, str, int)
+    key = cache.key("categories-page", page, after, exact)
+    result = cache.get(key)
+    if result is not None:
+        return page_response(request, result)
+    if CATEGORIES_BACKEND == "postgres":
+        result = await categories_list_postgres(page, after_key, exact)
+    else:
+        result = await categories_list_mongo(db, page, after_key, exact)
+    # The cache holds the encoded JSON, see rows.py
+    result = encode(categories_page(result))
+    cache.set(key, result)
+    return page_response(request, result)
+
+
+async def categories_list_postgres(page, after_key, exact=False):
+    async with async_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(*categories_page_query(page, after_key))
+            results = []
+            for row in await cur.fetchall():
+                record = {}
+                for i, column in enumerate(cur.description):
+                    record[column.name] = row[i]
+                results.append(record)
+
+            raw_count = await counts.table_async(conn, "categories", exact)
+            return {
+                "page_count": raw_count // 100,
+                "categories": results,
+            }
+
+
+async def categories_list_mongo(db, page, after_key, exact=False):
+    categories = db.categories.aggregate(
+        categories_page_pipeline(page, after_key)
+    )
+    categories = await categories.to_list(length=None)
+    count = await counts.collection_async(db, "categories", exact)
+    return {
+        "page_count": count // 100,
+        "categories": categories,
+    }
+
+
+async def categories_by_id(db, ids):
+    if CATEGORIES_BACKEND == "postgres":
+        async with async_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    SELECT id, title, canon
+                    FROM categories
+                    WHERE id = ANY(%s)
+                """,
+                    [ids],
+                )
+                categories = [
+                    {"id": row[0], "title": row[1], "canon": row[2]}
+                    for row in await cur.fetchall()
+                ]
+    else:
+        categories = await db.categories.find(
+            {"_id": {"$in": ids}},
+            CATEGORY_FIELDS,
+        ).to_list(length=None)
+    return category_batch(ids, categories)
+
+
+@router.get("/api/categories", response_model=CategoryBatch)
+async def categories_batch(ids: str, db=Depends(get_async_mongo_db)):
+    return await categories_by_id(db, parse_ids(ids))
+
+
+@router.post("/api/categories/lookup", response_model=CategoryBatch)
+async def categories_lookup(body: IdsIn, db=Depends(get_async_mongo_db)):
+    return await categories_by_id(db, check_ids(body.ids))
+
+
+@router.get(
+    "/api/category/{category_id}",
+    response_model=CategoryOut,
+    responses={404: {"model": Message}},
+)
+async def get_category(
+    request: Request,
+    category_id: int,
+    db=Depends(get_async_mongo_db),
+):
+    key = cache.key("category", category_id)
+    result = cache.get(key)
+    if result is not None:
+        return category_response(request, category_id, result)
+    result = await flights.do_async(
+        key,
+        lambda: load_category(db, category_id),
+        lambda result: cache.set(key, result),
+    )
+    if result is None:
+        return json_response(
+            {"message": "Category not found"},
+            status.HTTP_404_NOT_FOUND,
+        )
+    return category_response(request, category_id, result)
+
+
+async def load_category(db, category_id):
+    doc = await db.categories.find_one({"_id": category_id})
+    if doc is None:
+        return None
+    return category_cache_value(doc, category_body(doc))
+
+
+@router.post(
+    "/api/categories",
+    response_model=CategoryOut,
+    responses={409: {"model": Message}},
+)
+async def create_category(
+    category: CategoryIn,
+    conn=Depends(get_async_conn),
+):
+    async with conn.cursor() as cur:
+        try:
+            await cur.execute(
+                """
+                INSERT INTO categories (title, canon)
+                VALUES (%s, false)
+                RETURNING id, title, canon;
+            """,
+                [category.title],
+            )
+        except psycopg.errors.UniqueViolation:
+            return json_response(
+                {"message": "Could not create duplicate category"},
+                status.HTTP_409_CONFLICT,
+            )
+        row = await cur.fetchone()
+        record = {}
+        for i, column in enumerate(cur.description):
+            record[column.name] = row[i]
+    await conn.commit()
+    forget_category(record["id"])
+    return record
+
+
+@router.put(
+    "/api/categories/{category_id}",
+    response_model=CategoryOut,
+    responses={404: {"model": Message}},
+)
+async def update_category(
+    category_id: int,
+    category: CategoryIn,
+    response: Response,
+    conn=Depends(get_async_conn),
+):
+    async with conn.cursor() as cur:
+        await cur.execute(
+            """
+            UPDATE categories
+            SET title = %s
+            WHERE id = %s
+            RETURNING id, title, canon;
+        """,
+            [category.title, category_id],
+        )
+        row = await cur.fetchone()
+    await conn.commit()
+    if row is None:
+        return json_response(
+            {"message": "Category not found"},
+            status.HTTP_404_NOT_FOUND,
+        )
+    forget_category(category_id)
+    cache.clear_namespace("clue")
+    cache.clear_namespace("clues-page")
+    return json_response({"id": row[0], "title": row[1], "canon": row[2]})
+
+
+@router.delete(
+    "/api/categories/{category_id}",
+    response_model=Message,
+    responses={400: {"model": Message}},
+)
+async def remove_category(
+    category_id: int,
+    response: Response,
+    conn=Depends(get_async_conn),
+):
+    async with conn.cursor() as cur:
+        try:
+            await cur.execute(
+                """
+                DELETE FROM categories
+                WHERE id = %s;
+            """,
+                [category_id],
+            )
+            await conn.commit()
+            forget_category(category_id)
+            return {
+                "message": "Success",
+            }
+        except psycopg.errors.ForeignKeyViolation:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {
+                "message": "Cannot delete category because it has clues",
+            }
@@ -0,0 +1,192 @@
+from fastapi import APIRouter, Depends, Request, status
+from typing import Optional
+from batch import IdsIn, check_ids, parse_ids
+from cache import cache
+from counts import counts
+from db import async_connection, get_async_conn
+import invalidations
+import ratelimit
+import sampler
+from sampler import CLUE_COLUMNS
+from rows import clue_rows, encode, json_response
+from singleflight import flights
+from conditional import NO_STORE, has_validators, pack, page_response
+from .clues import (
+    CLUE_QUERY,
+    CLUE_VERSION_QUERY,
+    ClueOut,
+    ClueBatch,
+    ClueSearchResults,
+    Clues,
+    Message,
+    clue_batch,
+    clue_not_modified,
+    clue_record,
+    clue_response,
+    clue_search_page,
+    clue_search_query,
+    clues_by_id_query,
+    clues_page,
+    clues_page_query,
+    forget_clue,
+)
+
+# The async versions of the routes in clues.py, used when API_MODE is
+# "async" (see main.py)
+router = APIRouter()
+
+
+@router.get("/api/clues/search", response_model=ClueSearchResults)
+async def search_clues(
+    q: str,
+    fuzzy: bool = False,
+    after: Optional[str] = None,
+    conn=Depends(get_async_conn),
+):
+    async with conn.cursor() as cur:
+        await cur.execute(*clue_search_query(q, fuzzy, after))
+        return clue_search_page(await cur.fetchall())
+
+
+@router.get("/api/clues/{page}", response_model=Clues)
+async def clues_list(
+    request: Request,
+    page: int = 0,
+    after: Optional[str] = None,
+    exact: bool = False,
+):
+    key = cache.key("clues-page", page, after, exact)
+    result = cache.get(key)
+    if result is not None:
+        return page_response(request, result)
+    async with async_connection() as conn:
+        async with conn.cursor(row_factory=clue_rows) as cur:
+            await cur.execute(*clues_page_query(page, after))
+            results = await cur.fetchall()
+        raw_count = await counts.table_async(conn, "clues", exact)
+    result = clues_page(results, raw_count)
+    cache.set(key, result)
+    return page_response(request, result)
+
+
+async def clues_by_id(ids):
+    async with async_connection() as conn:
+        async with conn.cursor(row_factory=clue_rows) as cur:
+            await cur.execute(*clues_by_id_query(ids))
+            return clue_batch(ids, await cur.fetchall())
+
+
+@router.get("/api/clues", response_model=ClueBatch)
+async def clues_batch(ids: str):
+    return await clues_by_id(parse_ids(ids))
+
+
+@router.post("/api/clues/lookup", response_model=ClueBatch)
+async def clues_lookup(body: IdsIn):
+    return await clues_by_id(check_ids(body.ids))
+
+
+@router.get(
+    "/api/clue/{clue_id}",
+    response_model=ClueOut,
+    responses={404: {"model": Message}},
+)
+async def get_clue(request: Request, clue_id: int):
+    key = cache.key("clue", clue_id)
+    record = cache.get(key)
+    if record is not None:
+        return clue_response(request, clue_id, record)
+    if has_validators(request):
+        async with async_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(CLUE_VERSION_QUERY, [clue_id])
+                row = await cur.fetchone()
+        if row is not None:
+            response = clue_not_modified(request, clue_id, row[0])
+            if response is not None:
+                return response
+    record = await flights.do_async(
+        key,
+        lambda: load_clue(clue_id),
+        lambda record: cache.set(key, record),
+    )
+    if record is None:
+        return json_response(
+            {"message": "Category not found"},
+            status.HTTP_404_NOT_FOUND,
+        )
+    return clue_response(request, clue_id, record)
+
+
+async def load_clue(clue_id):
+    async with async_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(CLUE_QUERY, [clue_id])
+            row = await cur.fetchone()
+    if row is None:
+        return None
+    return pack(row[9], encode(clue_record(row)))
+
+
+@router.get(
+    "/api/random-clue",
+    response_model=ClueOut,
+    responses={404: {"model": Message}},
+    dependencies=[Depends(ratelimit.random_clue)],
+)
+async def random_clue(
+    valid: bool = True,
+    conn=Depends(get_async_conn),
+):
+    clue_sampler = sampler.valid_clues if valid else sampler.all_clues
+    rows = await clue_sampler.fetch_async(conn, 1)
+    if rows is not None:
+        row = rows[0] if rows else None
+    else:
+        # The sampler is still loading right after startup
+        async with conn.cursor() as cur:
+            await cur.execute(
+                f"""
+                SELECT {CLUE_COLUMNS}
+                FROM categories
+                    INNER JOIN clues
+                    ON (clues.category_id = categories.id)
+                WHERE {clue_sampler.where}
+                ORDER BY RANDOM()
+                LIMIT 1;
+            """
+            )
+            row = await cur.fetchone()
+    if row is None:
+        return json_response(
+            {"message": "Category not found"},
+            status.HTTP_404_NOT_FOUND,
+        )
+    return json_response(clue_record(row), headers={"Cache-Control": NO_STORE})
+
+
+@router.delete(
+    "/api/clues/{clue_id}",
+    response_model=ClueOut,
+    responses={404: {"model": Message}},
+)
+async def update_clue(clue_id: int, conn=Depends(get_async_conn)):
+    async with conn.cursor(row_factory=clue_rows) as cur:
+        if invalidations.MODE == "buffered":
+            await cur.execute(*clues_by_id_query([clue_id]))
+            clue = await cur.fetchone()
+            if clue is not None:
+                clue.invalid_count += invalidations.buffer.add(clue_id)
+        else:
+            await cur.execute(invalidations.INVALIDATE_CLUE, [clue_id])
+            clue = await cur.fetchone()
+            await conn.commit()
+            if clue is not None:
+                forget_clue(clue_id)
+    if clue is None:
+        return json_response(
+            {"message": "Category not found"},
+            status.HTTP_404_NOT_FOUND,
+        )
+    sampler.valid_clues.discard(clue_id)
+    return json_response(clue)
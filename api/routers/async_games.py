@@ -0,0 +1,75 @@
+from fastapi import APIRouter, Depends, Request
+from typing import Optional
+from counts import counts
+from db import get_async_conn
+import game_pool
+import ratelimit
+from rows import json_response
+from conditional import page_response
+from .clues import clue_record
+from .games import (
+    GAME_QUERY,
+    CustomGame,
+    GameWithTotalWon,
+    Games,
+    Message,
+    game_record,
+    game_response,
+    games_page,
+    games_page_query,
+)
+
+# The async versions of the routes in games.py, used when API_MODE is
+# "async" (see main.py)
+router = APIRouter()
+
+
+@router.get("/api/games/{page}", response_model=Games)
+async def games_list(
+    request: Request,
+    page: int = 0,
+    after: Optional[str] = None,
+    exact: bool = False,
+    conn=Depends(get_async_conn),
+):
+    async with conn.cursor() as cur:
+        await cur.execute(*games_page_query(page, after))
+        results = [game_record(row) for row in await cur.fetchall()]
+    raw_count = await counts.table_async(conn, "games", exact)
+    return page_response(request, games_page(results, raw_count))
+
+
+@router.get(
+    "/api/game/{game_id}",
+    response_model=GameWithTotalWon,
+    responses={404: {"model": Message}},
+)
+async def get_game(request: Request, game_id: int, conn=Depends(get_async_conn)):
+    async with conn.cursor() as cur:
+        await cur.execute(GAME_QUERY, [game_id])
+        row = await cur.fetchone()
+    return game_response(request, game_id, row)
+
+
+@router.post(
+    "/api/custom-games",
+    response_model=CustomGame,
+    dependencies=[Depends(ratelimit.custom_games)],
+)
+async def create_custom_game(conn=Depends(get_async_conn)):
+    claimed = await game_pool.games.claim_async(conn)
+    if claimed is not None:
+        game_def_id, game_def_created_on, clues = claimed
+    else:
+        clues = await game_pool.pick_clues_async(conn)
+        async with conn.cursor() as cur:
+            await cur.execute(
+                game_pool.CREATE_GAME_DEFINITION,
+                [False, [clue[3] for clue in clues]],
+            )
+            game_def_id, game_def_created_on = await cur.fetchone()
+    return json_response({
+        "id": game_def_id,
+        "created_on": game_def_created_on,
+        "clues": [clue_record(clue) for clue in clues],
+    })
@@ -0,0 +1,78 @@
+from fastapi import APIRouter, Depends, Query, Request, status
+from pydantic import BaseModel
+from db import get_conn
+from board_store import board_body, boards_body, store
+from rows import json_response
+from conditional import NO_STORE, content_etag, validated_response
+
+
+# Whole boards in one request, see board_store.py
+router = APIRouter()
+
+
+class BoardCategory(BaseModel):
+    id: int
+    title: str
+    canon: bool
+
+
+class BoardClue(BaseModel):
+    id: int
+    question: str
+    answer: str
+    value: int
+    invalid_count: int
+    canon: bool
+
+
+class BoardValue(BaseModel):
+    value: int
+    clues: list[BoardClue]
+
+
+class Board(BaseModel):
+    category: BoardCategory
+    # lowest value first
+    values: list[BoardValue]
+
+
+class Boards(BaseModel):
+    boards: list[Board]
+
+
+class Message(BaseModel):
+    message: str
+
+
+# The most categories /api/boards/random gives at once
+MAX_BOARD_CATEGORIES = 20
+
+
+# has to come before /api/boards/{category_id} or "random" would be taken
+# as a category id
+@router.get("/api/boards/random", response_model=Boards)
+def random_boards(
+    categories: int = Query(6, ge=1, le=MAX_BOARD_CATEGORIES),
+    conn=Depends(get_conn),
+):
+    return json_response(
+        boards_body(store.random(conn, categories)),
+        headers={"Cache-Control": NO_STORE},
+    )
+
+
+@router.get(
+    "/api/boards/{category_id}",
+    response_model=Board,
+    responses={404: {"model": Message}},
+)
+def get_board(request: Request, category_id: int, conn=Depends(get_conn)):
+    board = store.get(conn, category_id)
+    if board is None:
+        return json_response(
+            {"message": "Category not found"},
+            status.HTTP_404_NOT_FOUND,
+        )
+    # the board has no version of its own, the ETag is a hash of it
+    body = board_body(board)
+    return validated_response(request, body, content_etag(body))
@@ -1,18 +1,17 @@
-from fastapi import APIRouter, Response, status
+from fastapi import APIRouter, Depends, Request, Response, status
 from pydantic import BaseModel
 import psycopg
-import pymongo
 import os
 import bson
-from typing import Union
-
-
-dbhost = os.environ['MONGOHOST']
-dbname = os.environ['MONGODATABASE']
-dbuser = os.environ['MONGOUSER']
-dbpass = os.environ['MONGOPASSWORD']
-
-mongo_str = f"mongodb://{dbuser}:{dbpass}@{dbhost}"
+from typing import Optional, Union
+from cache import cache
+from counts import counts
+from rows import encode, json_response
+from singleflight import flights
+from conditional import EPOCH, content_etag, pack, page_response, unpack, validated_response, version_etag
+from db import connection, get_conn, get_mongo_db
+from batch import IdsIn, check_ids, in_request_order, parse_ids
+from pagination import decode_cursor, encode_cursor
 
 # Using routers for organization
 # See https://fastapi.tiangolo.com/tutorial/bigger-applications/
@@ -37,76 +36,268 @@ class CategoryWithClueCount(CategoryOut):
 class Categories(BaseModel):
     page_count: int
     categories: list[CategoryWithClueCount]
+    # pass this back as ?after= to get the next page, None on the last page
+    next: Optional[str] = None
 
 
 class Message(BaseModel):
     message: str
 
 
+class CategoryBatch(BaseModel):
+    # in the order they were asked for, None for the ids not found
+    categories: list[Optional[CategoryOut]]
+    not_found: list[int]
+
+
+# Which database categories_list reads from, "mongo" or "postgres".
+# Both give the same answer, one page always costs two queries.
+# Pages are sorted by title, then id so that the order is stable.
+CATEGORIES_BACKEND = os.environ.get("CATEGORIES_BACKEND", "mongo")
+
+
 #list
 @router.get("/api/categories/{page}", response_model=Categories)
-def categories_list(page: int = 0):
-    # Uses the environment variables to connect
-    # In development, see the docker-compose.yml file for
-    #   the PG settings in the "environment" section
-    #with psycopg.connect() as conn:
-        # with conn.cursor() as cur:
-        #     cur.execute(
-        #         """
-        #         SELECT cats.id, cats.title, cats.canon, count(*) AS num_clues
-        #         FROM categories AS cats
-        #         LEFT OUTER JOIN clues on (clues.category_id = cats.id)
-        #         group by cats.id, cats.title, cats.canon
-        #         ORDER BY cats.title
-        #         LIMIT 100 OFFSET %s
-        #     """,
-        #         [page * 100],
-        #     )
-
-        #     results = []
-        #     for row in cur.fetchall():
-        #         record = {}
-        #         for i, column in enumerate(cur.description):
-        #             record[column.name] = row[i]
-        #         results.append(record)
-
-        #     cur.execute(
-        #         """
-        #         SELECT COUNT(*) FROM categories;
-        #     """
-        #     )
-        #     raw_count = cur.fetchone()[0]
-        #     print(raw_count)
-        #     page_count = (raw_count // 100) + 1
-
-        #     return Categories(page_count=page_count, categories=results)
-    ##___________________________________________
-    #creates a new Mongo Client to talk to the DDBMS
-    client = pymongo.MongoClient(mongo_str)
-    #Gets the database from the value of an environment variable
-    db = client[dbname]
-    #Finds categories sorted by title, skipping the categories not needed due to the
-    #page parameter, and limiting the results to 100
-    categories = db.categories.find().sort("title").skip(100*page).limit(100)
+def categories_list(
+    request: Request,
+    page: int = 0,
+    after: Optional[str] = None,
+    # counts the categories for page_count instead of using the cached
+    # total, see counts.py
+    exact: bool = False,
+    db=Depends(get_mongo_db),
+):
+    # With an after cursor the page starts right after the (title, id) of
+    # the last category of the previous page, and the page number is ignored
+    after_key = None
+    if after is not None:
+        after_key = decode_cursor(after, str, int)
+    key = cache.key("categories-page", page, after, exact)
+    result = cache.get(key)
+    if result is not None:
+        return page_response(request, result)
+    if CATEGORIES_BACKEND == "postgres":
+        result = categories_list_postgres(page, after_key, exact)
+    else:
+        result = categories_list_mongo(db, page, after_key, exact)
+    # The cache holds the encoded JSON, see rows.py
+    result = encode(categories_page(result))
+    cache.set(key, result)
+    # ETag and Cache-Control, see conditional.py
+    return page_response(request, result)
+
+
+# Forgets the cached copies of a category after it changes, see cache.py
+def forget_category(category_id):
+    # a load that started before the change is not cached, see
+    # singleflight.py
+    flights.forget(cache.key("category", category_id))
+    cache.delete("category", category_id)
+    cache.clear_namespace("categories-page")
+    counts.forget("categories")
+
+
+# Called by category_sync.py once Mongo has the new categories, so reads
+# cached in between are dropped
+def forget_categories(category_ids):
+    for category_id in category_ids:
+        flights.forget(cache.key("category", category_id))
+        cache.delete("category", category_id)
+    cache.clear_namespace("categories-page")
+    counts.forget("categories")
+
+
+# The cached category with its version, see conditional.py. Categories
+# synced to Mongo before updated_at was copied over have none, those get
+# an ETag from the body instead.
+def category_cache_value(doc, body):
+    return pack(doc.get("updated_at") or EPOCH, body)
+
+
+def category_body(doc):
+    return encode({
+        "id": doc["_id"],
+        "title": doc["title"],
+        "canon": doc["canon"],
+    })
+
+
+def category_response(request, category_id, value):
+    updated_at, body = unpack(value)
+    if updated_at == EPOCH:
+        return validated_response(request, body, content_etag(body))
+    return validated_response(
+        request,
+        body,
+        version_etag("category", category_id, updated_at),
+        updated_at,
+    )
+
+
+# Adds the cursor of the next page, shared with async_categories.py
+def categories_page(result):
+    categories = result["categories"]
+    if len(categories) == 100:
+        last = categories[-1]
+        result["next"] = encode_cursor(last["title"], last["id"])
+    return result
+
+
+def categories_page_query(page, after_key):
+    if after_key is not None:
+        where = "WHERE (cats.title, cats.id) > (%s, %s)"
+        offset = 0
+        params = list(after_key)
+    else:
+        where = ""
+        offset = page * 100
+        params = []
+    # One query gets the page of categories and counts their clues.
+    # The count is a subquery so that it only runs for the 100
+    # categories on the page, and the page itself can be read in
+    # order from an index on (title, id)
+    sql = f"""
+        SELECT cats.id, cats.title, cats.canon,
+            (
+                SELECT count(*)
+                FROM clues
+                WHERE clues.category_id = cats.id
+            ) AS num_clues
+        FROM categories AS cats
+        {where}
+        ORDER BY cats.title, cats.id
+        LIMIT 100 OFFSET %s
+    """
+    return sql, params + [offset]
+
+
+def categories_list_postgres(page, after_key, exact=False):
+    # Borrows a connection from the shared pool, see db.py
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(*categories_page_query(page, after_key))
+
+            results = []
+            for row in cur.fetchall():
+                record = {}
+                for i, column in enumerate(cur.description):
+                    record[column.name] = row[i]
+                results.append(record)
+
+            raw_count = counts.table(conn, "categories", exact)
+            page_count = raw_count // 100
+
+            return {
+                "page_count": page_count,
+                "categories": results,
+            }
+
+
+def categories_page_pipeline(page, after_key):
+    #Finds categories sorted by title, then either starts after the cursor
+    #or skips the categories not needed due to the page parameter, and
+    #limits the results to 100.
+    if after_key is not None:
+        title, id = after_key
+        start = [
+            {"$match": {"$or": [
+                {"title": {"$gt": title}},
+                {"title": title, "_id": {"$gt": id}},
+            ]}},
+            {"$sort": {"title": 1, "_id": 1}},
+        ]
+    else:
+        start = [
+            {"$sort": {"title": 1, "_id": 1}},
+            {"$skip": 100 * page},
+        ]
+    #The $lookup counts the clues of each category on the page inside the
+    #same aggregation, instead of sending one count command per category
+    return start + [
+        {"$limit": 100},
+        {"$lookup": {
+            "from": "clues",
+            "let": {"category_id": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$category_id", "$$category_id"]}}},
+                {"$count": "n"},
+            ],
+            "as": "clue_count",
+        }},
+        {"$project": {
+            "_id": 0,
+            "id": "$_id",
+            "title": 1,
+            "canon": 1,
+            #$count gives no document at all when there are no clues
+            "num_clues": {"$ifNull": [{"$first": "$clue_count.n"}, 0]},
+        }},
+    ]
+
+
+def categories_list_mongo(db, page, after_key, exact=False):
+    #db is the database from the MongoClient shared by the whole
+    #server, see get_mongo_db in db.py
+    categories = db.categories.aggregate(
+        categories_page_pipeline(page, after_key)
+    )
     #turn the object returned from the query into a list
     categories = list(categories)
-    #Loop over each category in the list
-    for category in categories:
-        #counts the number of clues with the specified category_id
-        count = db.command({
-            "count": "clues",
-            "query": { "category_id": category["_id"] }
-        })
-        category["num_clues"] = count["n"]
-        category["id"] = category["_id"]
-        del category["_id"]
-    page_count = db.command({"count": "categories"})["n"] // 100
+    page_count = counts.collection(db, "categories", exact) // 100
     return {
         "page_count": page_count,
         "categories": categories,
     }
 
-            
+
+# Mongo projection that gives a CategoryOut
+CATEGORY_FIELDS = {"_id": 0, "id": "$_id", "title": 1, "canon": 1}
+
+
+def category_batch(ids, categories):
+    records, not_found = in_request_order(
+        ids,
+        {category["id"]: category for category in categories},
+    )
+    return json_response({"categories": records, "not_found": not_found})
+
+
+def categories_by_id(db, ids):
+    # One query for all of the ids
+    if CATEGORIES_BACKEND == "postgres":
+        with connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT id, title, canon
+                    FROM categories
+                    WHERE id = ANY(%s)
+                """,
+                    [ids],
+                )
+                categories = [
+                    {"id": row[0], "title": row[1], "canon": row[2]}
+                    for row in cur.fetchall()
+                ]
+    else:
+        categories = db.categories.find(
+            {"_id": {"$in": ids}},
+            CATEGORY_FIELDS,
+        )
+    return category_batch(ids, categories)
+
+
+# get many by id, for example /api/categories?ids=1,2,3
+@router.get("/api/categories", response_model=CategoryBatch)
+def categories_batch(ids: str, db=Depends(get_mongo_db)):
+    return categories_by_id(db, parse_ids(ids))
+
+
+# the same, with the ids in the body for long lists
+@router.post("/api/categories/lookup", response_model=CategoryBatch)
+def categories_lookup(body: IdsIn, db=Depends(get_mongo_db)):
+    return categories_by_id(db, check_ids(body.ids))
+
 
 #getdetail
 @router.get(
@@ -114,7 +305,7 @@ def categories_list(page: int = 0):
     response_model=CategoryOut,
     responses={404: {"model": Message}},
 )
-def get_category(category_id: int, response: Response):
+def get_category(request: Request, category_id: int, db=Depends(get_mongo_db)):
     # with psycopg.connect() as conn:
     #     with conn.cursor() as cur:
     #         cur.execute(
@@ -134,12 +325,31 @@ def get_category(category_id: int, response: Response):
     #             record[column.name] = row[i]
     #         return record
 # __________________________________________
-    client = pymongo.MongoClient(mongo_str)
-    db = client[dbname]
-    result = db.categories.find_one({"_id": category_id})
-    result["id"] = result["_id"]
-    del result["_id"]
-    return result
+    key = cache.key("category", category_id)
+    result = cache.get(key)
+    if result is not None:
+        return category_response(request, category_id, result)
+    # Requests for the same category at the same time share one query,
+    # see singleflight.py
+    result = flights.do(
+        key,
+        lambda: load_category(db, category_id),
+        lambda result: cache.set(key, result),
+    )
+    if result is None:
+        return json_response(
+            {"message": "Category not found"},
+            status.HTTP_404_NOT_FOUND,
+        )
+    return category_response(request, category_id, result)
+
+
+# The category as it is cached, or None when there is no such category
+def load_category(db, category_id):
+    doc = db.categories.find_one({"_id": category_id})
+    if doc is None:
+        return None
+    return category_cache_value(doc, category_body(doc))
 
 
 
@@ -148,32 +358,37 @@ def get_category(category_id: int, response: Response):
     response_model=CategoryOut,
     responses={409: {"model": Message}},
 )
-def create_category(category: CategoryIn, response: Response):
-    with psycopg.connect() as conn:
-        with conn.cursor() as cur:
-            try:
-                # Uses the RETURNING clause to get the data
-                # just inserted into the database. See
-                # https://www.postgresql.org/docs/current/sql-insert.html
-                cur.execute(
-                    """
-                    INSERT INTO categories (title, canon)
-                    VALUES (%s, false)
-                    RETURNING id, title, canon;
-                """,
-                    [category.title],
-                )
-            except psycopg.errors.UniqueViolation:
-                # status values at https://github.com/encode/starlette/blob/master/starlette/status.py
-                response.status_code = status.HTTP_409_CONFLICT
-                return {
-                    "message": "Could not create duplicate category",
-                }
-            row = cur.fetchone()
-            record = {}
-            for i, column in enumerate(cur.description):
-                record[column.name] = row[i]
-            return record
+def create_category(category: CategoryIn, conn=Depends(get_conn)):
+    with conn.cursor() as cur:
+        try:
+            # Uses the RETURNING clause to get the data
+            # just inserted into the database. See
+            # https://www.postgresql.org/docs/current/sql-insert.html
+            cur.execute(
+                """
+                INSERT INTO categories (title, canon)
+                VALUES (%s, false)
+                RETURNING id, title, canon;
+            """,
+                [category.title],
+            )
+        except psycopg.errors.UniqueViolation:
+            # status values at https://github.com/encode/starlette/blob/master/starlette/status.py
+            # A plain dict would be checked against CategoryOut and fail
+            return json_response(
+                {"message": "Could not create duplicate category"},
+                status.HTTP_409_CONFLICT,
+            )
+        row = cur.fetchone()
+        record = {}
+        for i, column in enumerate(cur.description):
+            record[column.name] = row[i]
+    # commit before forgetting the cached pages, so they can't be cached
+    # again without the new category in between
+    conn.commit()
+    # the pages and the cached total, see counts.py
+    forget_category(record["id"])
+    return record
 
 
 @router.put(
@@ -181,18 +396,36 @@ def create_category(category: CategoryIn, response: Response):
     response_model=CategoryOut,
     responses={404: {"model": Message}},
 )
-def update_category(category_id: int, category: CategoryIn, response: Response):
-    with psycopg.connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                UPDATE categories
-                SET title = %s
-                WHERE id = %s;
-            """,
-                [category.title, category_id],
-            )
-    return get_category(category_id, response)
+def update_category(
+    category_id: int,
+    category: CategoryIn,
+    response: Response,
+    conn=Depends(get_conn),
+):
+    with conn.cursor() as cur:
+        # The updated category comes straight from PostgreSQL, Mongo only
+        # gets it a little later (see category_sync.py)
+        cur.execute(
+            """
+            UPDATE categories
+            SET title = %s
+            WHERE id = %s
+            RETURNING id, title, canon;
+        """,
+            [category.title, category_id],
+        )
+        row = cur.fetchone()
+    conn.commit()
+    if row is None:
+        return json_response(
+            {"message": "Category not found"},
+            status.HTTP_404_NOT_FOUND,
+        )
+    forget_category(category_id)
+    # every cached clue includes its category
+    cache.clear_namespace("clue")
+    cache.clear_namespace("clues-page")
+    return json_response({"id": row[0], "title": row[1], "canon": row[2]})
 
 
 @router.delete(
@@ -200,22 +433,23 @@ def update_category(category_id: int, category: CategoryIn, response: Response):
     response_model=Message,
     responses={400: {"model": Message}},
 )
-def remove_category(category_id: int, response: Response):
-    with psycopg.connect() as conn:
-        with conn.cursor() as cur:
-            try:
-                cur.execute(
-                    """
-                    DELETE FROM categories
-                    WHERE id = %s;
-                """,
-                    [category_id],
-                )
-                return {
-                    "message": "Success",
-                }
-            except psycopg.errors.ForeignKeyViolation:
-                response.status_code = status.HTTP_400_BAD_REQUEST
-                return {
-                    "message": "Cannot delete category because it has clues",
-                }
+def remove_category(category_id: int, response: Response, conn=Depends(get_conn)):
+    with conn.cursor() as cur:
+        try:
+            cur.execute(
+                """
+                DELETE FROM categories
+                WHERE id = %s;
+            """,
+                [category_id],
+            )
+            conn.commit()
+            forget_category(category_id)
+            return {
+                "message": "Success",
+            }
+        except psycopg.errors.ForeignKeyViolation:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {
+                "message": "Cannot delete category because it has clues",
+            }
@@ -1,6 +1,29 @@
-from fastapi import APIRouter, Response, status
+from fastapi import APIRouter, Depends, Request, status
 from pydantic import BaseModel
-import psycopg
+from typing import Optional
+from cache import cache
+from counts import counts
+from db import connection, get_conn
+from batch import IdsIn, check_ids, in_request_order, parse_ids
+from pagination import decode_cursor, encode_cursor
+import invalidations
+import ratelimit
+import sampler
+from sampler import CLUE_COLUMNS
+from rows import clue_record, clue_rows, encode, json_response
+from singleflight import flights
+from conditional import (
+    NO_STORE,
+    not_modified,
+    not_modified_response,
+    DETAIL_CACHE_CONTROL,
+    has_validators,
+    pack,
+    page_response,
+    unpack,
+    validated_response,
+    version_etag,
+)
 from .categories import CategoryOut
 
 router = APIRouter()
@@ -22,60 +45,245 @@ class ClueOut(BaseModel):
 class Clues(BaseModel):
     page_count: int
     clues: list[ClueOut]
+    # pass this back as ?after= to get the next page, None on the last page
+    next: Optional[str] = None
 
 class Message(BaseModel):
     message:str
 
+class ClueSearchResults(BaseModel):
+    # best matches first
+    clues: list[ClueOut]
+    # pass this back as ?after= to get the next page, None on the last page
+    next: Optional[str] = None
+
+class ClueBatch(BaseModel):
+    # in the order they were asked for, None for the ids not found
+    clues: list[Optional[ClueOut]]
+    not_found: list[int]
+
+
+# search
+
+# Builds the query for one page of search results, shared with
+# async_clues.py. Normal searches use the full text index on the question
+# and answer (see schema.py) and understand quotes, "or" and "-word".
+# Fuzzy searches compare the answer letter by letter, so they still find
+# answers that are misspelled.
+def clue_search_query(q, fuzzy, after):
+    if fuzzy:
+        # the % operator is "similar enough", written %% here because
+        # psycopg uses % for parameters
+        matches = """
+            SELECT clues.id, similarity(clues.answer, %s) AS rank
+            FROM clues
+            WHERE clues.answer %% %s
+        """
+        params = [q, q]
+    else:
+        matches = """
+            SELECT clues.id, ts_rank(clues.search, query) AS rank
+            FROM clues, websearch_to_tsquery('english', %s) AS query
+            WHERE clues.search @@ query
+        """
+        params = [q]
+    # With an after cursor the page starts right after the (rank, id) of
+    # the last clue of the previous page. ts_rank and similarity give a
+    # real, so the rank from the cursor is turned back into a real before
+    # comparing. As a double it is never equal to the rank it came from,
+    # and ties at the end of a page would be skipped or repeated forever.
+    where = ""
+    if after is not None:
+        rank, after_id = decode_cursor(after, float, int)
+        where = """
+            WHERE matches.rank < %s::real
+                OR (matches.rank = %s::real AND matches.id > %s)
+        """
+        params += [rank, rank, after_id]
+    sql = f"""
+        WITH matches AS ({matches})
+        SELECT {CLUE_COLUMNS}, matches.rank
+        FROM matches
+            INNER JOIN clues
+            ON (clues.id = matches.id)
+            INNER JOIN categories
+            ON (clues.category_id = categories.id)
+        {where}
+        ORDER BY matches.rank DESC, matches.id
+        LIMIT 100
+    """
+    return sql, params
+
+
+def clue_search_page(rows):
+    next_cursor = None
+    if len(rows) == 100:
+        last = rows[-1]
+        next_cursor = encode_cursor(float(last[9]), last[3])
+    return json_response({
+        "clues": [clue_record(row) for row in rows],
+        "next": next_cursor,
+    })
+
+
+# has to come before /api/clues/{page} or "search" would be taken as a page
+@router.get("/api/clues/search", response_model=ClueSearchResults)
+def search_clues(
+    q: str,
+    fuzzy: bool = False,
+    after: Optional[str] = None,
+    conn=Depends(get_conn),
+):
+    with conn.cursor() as cur:
+        cur.execute(*clue_search_query(q, fuzzy, after))
+        return clue_search_page(cur.fetchall())
+
 # get list
 
+# Builds the query for one page of clues, shared with async_clues.py
+def clues_page_query(page, after):
+    # With an after cursor the page starts right after the last clue id
+    # of the previous page, and the page number is ignored
+    if after is not None:
+        (after_id,) = decode_cursor(after, int)
+        where = "WHERE clues.id > %s"
+        offset = 0
+        params = [after_id]
+    else:
+        where = ""
+        offset = page * 100
+        params = []
+    sql = f"""
+        SELECT {CLUE_COLUMNS}
+        FROM categories
+            INNER JOIN clues
+            ON (clues.category_id = categories.id)
+        {where}
+        ORDER BY clues.id
+        LIMIT 100 OFFSET %s
+    """
+    return sql, params + [offset]
+
+
+# Encodes a page of ClueRows as the JSON of a Clues response
+def clues_page(results, raw_count):
+    page_count = (raw_count // 100) + 1
+    next_cursor = None
+    if len(results) == 100:
+        next_cursor = encode_cursor(results[-1].id)
+    return encode({
+        "page_count": page_count,
+        "clues": results,
+        "next": next_cursor,
+    })
+
+
+# Forgets the cached copies of a clue after it changes, see cache.py. A
+# load of the clue that started before the change is not cached either,
+# see singleflight.py
+def forget_clue(clue_id):
+    flights.forget(cache.key("clue", clue_id))
+    cache.delete("clue", clue_id)
+    cache.clear_namespace("clues-page")
+
+
+# The clue with its updated_at, which is the newest of the clue's and its
+# category's since the response includes both
+CLUE_QUERY = f"""
+    SELECT {CLUE_COLUMNS},
+        GREATEST(clues.updated_at, categories.updated_at)
+    FROM categories
+        INNER JOIN clues
+        ON (clues.category_id = categories.id)
+    WHERE clues.id = %s
+"""
+
+# Only the version, for answering a conditional GET with a 304 when the
+# clue is not cached
+CLUE_VERSION_QUERY = """
+    SELECT GREATEST(clues.updated_at, categories.updated_at)
+    FROM categories
+        INNER JOIN clues
+        ON (clues.category_id = categories.id)
+    WHERE clues.id = %s
+"""
+
+
+# The cached clue keeps its version next to the JSON, see conditional.py
+def clue_response(request, clue_id, value):
+    updated_at, body = unpack(value)
+    return validated_response(
+        request, body, version_etag("clue", clue_id, updated_at), updated_at
+    )
+
+
+def clue_not_modified(request, clue_id, updated_at):
+    etag = version_etag("clue", clue_id, updated_at)
+    if not_modified(request, etag, updated_at):
+        return not_modified_response(etag, updated_at, DETAIL_CACHE_CONTROL)
+    return None
+
+
 @router.get("/api/clues/{page}", response_model = Clues)
-def clues_list(page: int = 0):
-    with psycopg.connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT categories.id, categories.title, categories.canon,
-                        clues.id, clues.question, clues.answer,
-                        clues.value, clues.invalid_count, 
-                        clues.canon
-                FROM categories
-                    INNER JOIN clues
-                    ON (clues.category_id = categories.id)
-                ORDER BY clues.id
-                LIMIT 100 OFFSET %s
-            """, 
-                [page * 100],
-            )
-            #the way this is done in categories will not work here
-            # here we are dealing with multiple tables
-            # and the logic would get messed up when using that
-            #automated index
-            results = []
-            for row in cur.fetchall():
-                record = {
-                    "id": row[3],
-                    "question": row[4],
-                    "answer": row[5],
-                    "value": row[6],
-                    "invalid_count": row[7],
-                    "canon": row[8],
-                    "category": {
-                        "id": row[0],
-                        "title": row[1],
-                        "canon": row[2],
-                    }
-                }
-                results.append(record)
+def clues_list(
+    request: Request,
+    page: int = 0,
+    after: Optional[str] = None,
+    exact: bool = False,
+):
+    # The cache holds the encoded JSON, see rows.py
+    key = cache.key("clues-page", page, after, exact)
+    result = cache.get(key)
+    if result is not None:
+        return page_response(request, result)
+    # Only borrows a connection when the page is not cached
+    with connection() as conn:
+        with conn.cursor(row_factory=clue_rows) as cur:
+            cur.execute(*clues_page_query(page, after))
+            results = cur.fetchall()
+        # Usually a cached total, see counts.py
+        raw_count = counts.table(conn, "clues", exact)
+    result = clues_page(results, raw_count)
+    cache.set(key, result)
+    # ETag and Cache-Control, see conditional.py
+    return page_response(request, result)
 
-            cur.execute(
-                """
-                SELECT COUNT(*) FROM clues;
-            """
-            )
-            raw_count = cur.fetchone()[0]
-            page_count = (raw_count // 100) + 1
+# Builds the query for looking up many clues at once, shared with
+# async_clues.py
+def clues_by_id_query(ids):
+    sql = f"""
+        SELECT {CLUE_COLUMNS}
+        FROM categories
+            INNER JOIN clues
+            ON (clues.category_id = categories.id)
+        WHERE clues.id = ANY(%s)
+    """
+    return sql, [ids]
+
+
+def clue_batch(ids, clues):
+    records, not_found = in_request_order(ids, {clue.id: clue for clue in clues})
+    return json_response({"clues": records, "not_found": not_found})
+
+
+def clues_by_id(ids):
+    # One query for all of the ids
+    with connection() as conn:
+        with conn.cursor(row_factory=clue_rows) as cur:
+            cur.execute(*clues_by_id_query(ids))
+            return clue_batch(ids, cur.fetchall())
+
+
+# get many by id, for example /api/clues?ids=1,2,3
+@router.get("/api/clues", response_model=ClueBatch)
+def clues_batch(ids: str):
+    return clues_by_id(parse_ids(ids))
 
-            return Clues(page_count=page_count, clues=results)
+
+# the same, with the ids in the body for long lists
+@router.post("/api/clues/lookup", response_model=ClueBatch)
+def clues_lookup(body: IdsIn):
+    return clues_by_id(check_ids(body.ids))
 
 #get detail
 
@@ -84,40 +292,46 @@ def clues_list(page: int = 0):
     response_model=ClueOut,
     responses={404: {"model": Message}},
 )
-def get_clue(clue_id: int, response:Response):
-    with psycopg.connect() as conn:
+def get_clue(request: Request, clue_id: int):
+    key = cache.key("clue", clue_id)
+    record = cache.get(key)
+    if record is not None:
+        return clue_response(request, clue_id, record)
+    # A client sending back the ETag or date it has only needs the version
+    # to get its 304, not the whole clue
+    if has_validators(request):
+        with connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(CLUE_VERSION_QUERY, [clue_id])
+                row = cur.fetchone()
+        if row is not None:
+            response = clue_not_modified(request, clue_id, row[0])
+            if response is not None:
+                return response
+    # Requests for the same clue at the same time share one query, see
+    # singleflight.py
+    record = flights.do(
+        key,
+        lambda: load_clue(clue_id),
+        lambda record: cache.set(key, record),
+    )
+    if record is None:
+        return json_response(
+            {"message": "Category not found"},
+            status.HTTP_404_NOT_FOUND,
+        )
+    return clue_response(request, clue_id, record)
+
+
+# The clue as it is cached, or None when there is no such clue
+def load_clue(clue_id):
+    with connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                SELECT categories.id, categories.title, categories.canon,
-                        clues.id, clues.question, clues.answer,
-                        clues.value, clues.invalid_count, 
-                        clues.canon
-                FROM categories
-                    INNER JOIN clues
-                    ON (clues.category_id = categories.id)
-                WHERE clues.id = %s
-            """,
-                [clue_id],
-            )
+            cur.execute(CLUE_QUERY, [clue_id])
             row = cur.fetchone()
-            if row is None:
-                response.status_code = status.HTTP_404_NOT_FOUND
-                return {"message": "Category not found"}
-            record = {
-                "id": row[3],
-                "question": row[4],
-                "answer": row[5],
-                "value": row[6],
-                "invalid_count": row[7],
-                "canon": row[8],
-                "category": {
-                    "id": row[0],
-                    "title": row[1],
-                    "canon": row[2],
-                }
-            }
-            return record
+    if row is None:
+        return None
+    return pack(row[9], encode(clue_record(row)))
 
 
 
@@ -126,9 +340,17 @@ def get_clue(clue_id: int, response:Response):
     "/api/random-clue",
     response_model= ClueOut,
     responses={404: {"model": Message}},
+    # each client gets so many a second, see ratelimit.py
+    dependencies=[Depends(ratelimit.random_clue)],
 )
-def random_clue(response: Response, valid: bool = True):
-    with psycopg.connect() as conn:
+def random_clue(valid: bool = True, conn=Depends(get_conn)):
+    # Picks from the clue ids kept in memory, see sampler.py
+    clue_sampler = sampler.valid_clues if valid else sampler.all_clues
+    rows = clue_sampler.fetch(conn, 1)
+    if rows is not None:
+        row = rows[0] if rows else None
+    else:
+        # The sampler is still loading right after startup
         with conn.cursor() as cur:
             invalid_case = " "
             if valid: 
@@ -150,23 +372,22 @@ def random_clue(response: Response, valid: bool = True):
             # added formatted string, but 
             )
             row = cur.fetchone()
-            if row is None:
-                response.status_code = status.HTTP_404_NOT_FOUND
-                return {"message": "Category not found"}
-            record = {
-                "id": row[3],
-                "question": row[4],
-                "answer": row[5],
-                "value": row[6],
-                "invalid_count": row[7],
-                "canon": row[8],
-                "category": {
-                    "id": row[0],
-                    "title": row[1],
-                    "canon": row[2],
-                }
-            }
-            return record
+    if row is None:
+        return json_response(
+            {"message": "Category not found"},
+            status.HTTP_404_NOT_FOUND,
+        )
+    # every response is a different clue
+    return json_response(clue_record(row), headers={"Cache-Control": NO_STORE})
+
+def forget_clues(clue_ids):
+    # Called after buffered invalidation votes are written, see
+    # invalidations.py
+    for clue_id in clue_ids:
+        flights.forget(cache.key("clue", clue_id))
+        cache.delete("clue", clue_id)
+    cache.clear_namespace("clues-page")
+
 
 #Do not actually delete the clue!! 
 @router.delete(
@@ -174,49 +395,29 @@ def random_clue(response: Response, valid: bool = True):
     response_model=ClueOut, 
     responses={404: {"model": Message}},
 )
-def update_clue(clue_id: int, response: Response):
-    with psycopg.connect() as conn: 
-        with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    UPDATE clue
-                    SET invalid_count = invalid_count + 1,
-                    WHERE id = %s;
-                    """, 
-                        [clue_id],
-                )
-                cur.execute(
-                    f"""
-                    SELECT categories.id, categories.title, categories.canon,
-                        clues.id, clues.question, clues.answer,
-                        clues.value, clues.invalid_count, 
-                        clues.canon
-                    FROM categories
-                    INNER JOIN clues
-                    ON (clues.category_id = categories.id)
-                    WHERE clues.id = %s
-                """,
-                    [clue_id],
-                )
-                row = cur.fetchone()
-                if row is None:
-                    response.status_code = status.HTTP_404_NOT_FOUND
-                    return {"message": "Category not found"}
-                record = {
-                    "id": row[3],
-                    "question": row[4],
-                    "answer": row[5],
-                    "value": row[6],
-                    "invalid_count": row[7],
-                    "canon": row[8],
-                    "category": {
-                        "id": row[0],
-                        "title": row[1],
-                        "canon": row[2],
-                    }
-                }
-                return record
-
-        
-
-
+def update_clue(clue_id: int, conn=Depends(get_conn)):
+    with conn.cursor(row_factory=clue_rows) as cur:
+        if invalidations.MODE == "buffered":
+            # The vote is written later together with the others, the
+            # answer shows the count including the votes still waiting
+            cur.execute(*clues_by_id_query([clue_id]))
+            clue = cur.fetchone()
+            if clue is not None:
+                clue.invalid_count += invalidations.buffer.add(clue_id)
+        else:
+            # One statement adds the vote and reads the clue back
+            cur.execute(invalidations.INVALIDATE_CLUE, [clue_id])
+            clue = cur.fetchone()
+            # commit before forgetting the cached copies, so they can't be
+            # cached again from the old row in between
+            conn.commit()
+            if clue is not None:
+                forget_clue(clue_id)
+    if clue is None:
+        return json_response(
+            {"message": "Category not found"},
+            status.HTTP_404_NOT_FOUND,
+        )
+    # the clue can't be picked as a valid random clue anymore
+    sampler.valid_clues.discard(clue_id)
+    return json_response(clue)
@@ -0,0 +1,123 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
+from typing import Optional
+from db import connection, get_mongo_db
+from rows import encode
+from sampler import CLUE_COLUMNS
+from .categories import CATEGORIES_BACKEND
+from .clues import clue_record
+
+
+# Streams a whole table as newline-delimited JSON, one record per line, so
+# a client can pull everything in one request instead of thousands of
+# pages. Rows are read from the database in batches while the response is
+# being sent, so memory use stays the same however big the table is.
+router = APIRouter()
+
+# How many rows are read from the database at a time
+BATCH_SIZE = 2000
+
+
+def stream_query(name, sql, params, to_record):
+    def rows():
+        with connection() as conn:
+            # stops here until the response starts streaming
+            yield b""
+            # A named cursor is a server-side cursor, PostgreSQL keeps the
+            # results and sends them BATCH_SIZE rows at a time
+            with conn.cursor(name=name) as cur:
+                cur.itersize = BATCH_SIZE
+                cur.execute(sql, params)
+                while True:
+                    batch = cur.fetchmany(BATCH_SIZE)
+                    if not batch:
+                        break
+                    yield b"".join(
+                        encode(to_record(row)) + b"\n" for row in batch
+                    )
+
+    # Runs the generator up to its first yield, so the connection is
+    # borrowed now and a busy pool still gets a 503. Once it has started,
+    # closing the generator gives the connection back, also when the
+    # client goes away before the first row or the response is never sent
+    # (an unstarted generator would skip its body and keep it).
+    stream = rows()
+    next(stream)
+    return StreamingResponse(stream, media_type="application/x-ndjson")
+
+
+@router.get("/api/export/clues")
+def export_clues(
+    valid: Optional[bool] = None,
+    canon: Optional[bool] = None,
+    category_id: Optional[int] = None,
+):
+    conditions = []
+    params = []
+    if valid is not None:
+        conditions.append(
+            "clues.invalid_count = 0" if valid else "clues.invalid_count > 0"
+        )
+    if canon is not None:
+        conditions.append("clues.canon = %s")
+        params.append(canon)
+    if category_id is not None:
+        conditions.append("clues.category_id = %s")
+        params.append(category_id)
+    where = ""
+    if conditions:
+        where = "WHERE " + " AND ".join(conditions)
+
+    sql = f"""
+        SELECT {CLUE_COLUMNS}
+        FROM categories
+            INNER JOIN clues
+            ON (clues.category_id = categories.id)
+        {where}
+        ORDER BY clues.id
+    """
+    return stream_query("export_clues", sql, params, clue_record)
+
+
+def category_record(row):
+    return {"id": row[0], "title": row[1], "canon": row[2]}
+
+
+@router.get("/api/export/categories")
+def export_categories(canon: Optional[bool] = None, db=Depends(get_mongo_db)):
+    if CATEGORIES_BACKEND == "postgres":
+        where = ""
+        params = []
+        if canon is not None:
+            where = "WHERE canon = %s"
+            params.append(canon)
+        sql = f"""
+            SELECT id, title, canon
+            FROM categories
+            {where}
+            ORDER BY id
+        """
+        return stream_query("export_categories", sql, params, category_record)
+
+    query = {}
+    if canon is not None:
+        query["canon"] = canon
+
+    def rows():
+        # The Mongo cursor also fetches BATCH_SIZE documents at a time
+        categories = db.categories.find(
+            query,
+            {"_id": 1, "title": 1, "canon": 1},
+            batch_size=BATCH_SIZE,
+        ).sort("_id")
+        batch = []
+        for category in categories:
+            row = (category["_id"], category["title"], category["canon"])
+            batch.append(encode(category_record(row)) + b"\n")
+            if len(batch) == BATCH_SIZE:
+                yield b"".join(batch)
+                batch = []
+        if batch:
+            yield b"".join(batch)
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
@@ -1,8 +1,15 @@
 from datetime import datetime
-from fastapi import APIRouter, Response, status
+from fastapi import APIRouter, Depends, Request, status
 from pydantic import BaseModel
-import psycopg
-from .clues import ClueOut
+from typing import Optional
+from counts import counts
+from db import get_conn
+from pagination import decode_cursor, encode_cursor
+import game_pool
+import ratelimit
+from rows import encode, json_response
+from conditional import page_response, validated_response, version_etag
+from .clues import ClueOut, clue_record
 
 
 router = APIRouter()
@@ -27,142 +34,151 @@ class CustomGame(BaseModel):
    
 class Games(BaseModel):
     page_count: int
-    games: GameWithTotalWon
+    games: list[GameWithTotalWon]
+    # pass this back as ?after= to get the next page, None on the last page
+    next: Optional[str] = None
 
 class Message(BaseModel):
     message:str
 
 
 
+# The total of each game comes from the game_totals table, which a
+# trigger keeps up to date when clues change (see schema.py), so these
+# are primary key lookups instead of adding up the clues every time
+GAME_COLUMNS = """
+    games.id, games.episode_id, games.aired, games.canon,
+    COALESCE(game_totals.total_amount_won, 0) AS total_amount_won
+"""
+
+
+# One game with its updated_at, the newest of the game's and its total's
+GAME_QUERY = f"""
+    SELECT {GAME_COLUMNS},
+        GREATEST(games.updated_at, game_totals.updated_at)
+    FROM games
+        LEFT OUTER JOIN game_totals
+        ON (game_totals.game_id = games.id)
+    WHERE games.id = %s
+"""
+
+
+def game_record(row):
+    return {
+        "id": row[0],
+        "episode_id": row[1],
+        "aired": row[2],
+        "canon": row[3],
+        "total_amount_won": row[4] 
+        }
+
+
+# Builds the query for one page of games, shared with async_games.py
+def games_page_query(page, after):
+    # With an after cursor the page starts right after the last game id
+    # of the previous page, and the page number is ignored
+    if after is not None:
+        (after_id,) = decode_cursor(after, int)
+        where = "WHERE games.id > %s"
+        offset = 0
+        params = [after_id]
+    else:
+        where = ""
+        offset = page * 100
+        params = []
+    sql = f"""
+        SELECT {GAME_COLUMNS}
+        FROM games
+            LEFT OUTER JOIN game_totals
+            ON (game_totals.game_id = games.id)
+        {where}
+        ORDER BY games.id
+        LIMIT 100 OFFSET %s
+    """
+    return sql, params + [offset]
+
+
+# Encodes a page of game records as the JSON of a Games response, shared
+# with async_games.py
+def games_page(results, raw_count):
+    page_count = (raw_count // 100) + 1
+    next_cursor = None
+    if len(results) == 100:
+        next_cursor = encode_cursor(results[-1]["id"])
+    return encode({
+        "page_count": page_count,
+        "games": results,
+        "next": next_cursor,
+    })
+
+
+@router.get("/api/games/{page}", response_model=Games)
+def games_list(
+    request: Request,
+    page: int = 0,
+    after: Optional[str] = None,
+    # counts the games for page_count instead of using the cached total,
+    # see counts.py
+    exact: bool = False,
+    conn=Depends(get_conn),
+):
+    with conn.cursor() as cur:
+        cur.execute(*games_page_query(page, after))
+        results = [game_record(row) for row in cur.fetchall()]
+    raw_count = counts.table(conn, "games", exact)
+    # ETag and Cache-Control, see conditional.py
+    return page_response(request, games_page(results, raw_count))
+
+
 @router.get(
     "/api/game/{game_id}",
     response_model=GameWithTotalWon,
     responses={404: {"model": Message}},
 )
-def get_game(game_id: int, response: Response):
-    with psycopg.connect() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                SELECT games.id, games.episode_id, games.aired, games.canon, 
-                SUM(clues.value) AS total_amount_won
-                FROM games
-                    LEFT OUTER JOIN clues
-                    ON (clues.game_id = games.id)
-                WHERE games.id = %s
-                GROUP BY games.id, games.episode_id, games.aired, games.canon
-            """,
-                [game_id],
-            )
-            row = cur.fetchone()
-            if row is None:
-                response.status_code = status.HTTP_404_NOT_FOUND
-                return {"message": "Category not found"}
-            record = {
-                "id": row[0],
-                "episode_id": row[1],
-                "aired": row[2],
-                "canon": row[3],
-                "total_amount_won": row[4] 
-                }
-            return record
+def get_game(request: Request, game_id: int, conn=Depends(get_conn)):
+    with conn.cursor() as cur:
+        cur.execute(GAME_QUERY, [game_id])
+        row = cur.fetchone()
+    return game_response(request, game_id, row)
+
+
+# Shared with async_games.py
+def game_response(request, game_id, row):
+    if row is None:
+        return json_response(
+            {"message": "Game not found"},
+            status.HTTP_404_NOT_FOUND,
+        )
+    # GREATEST skips the NULL of a game without a total
+    updated_at = row[5]
+    return validated_response(
+        request,
+        encode(game_record(row)),
+        version_etag("game", game_id, updated_at),
+        updated_at,
+    )
 
 @router.post(
     "/api/custom-games",
-    response_model = CustomGame
+    response_model = CustomGame,
+    # each client gets so many a second, see ratelimit.py
+    dependencies=[Depends(ratelimit.custom_games)],
 )
-def create_custom_game():
-    with psycopg.connect() as conn:
-        with conn.cursor() as cur:
-                # Uses the RETURNING clause to get the data
-                # just inserted into the database. See
-                # https://www.postgresql.org/docs/current/sql-insert.html
-                cur.execute(
-                    """
-                    SELECT categories.id, categories.title, categories.canon,
-                            clues.id, clues.answer, clues.question, clues.value,
-                            clues.invalid_count, clues.canon
-                    FROM categories
-                        INNER JOIN clues
-                        ON (clues.category_id = categories.id) 
-                    WHERE clues.canon IS true
-                    ORDER BY RANDOM() LIMIT 30
-                """,
-                )
-                thirtyclues = cur.fetchall()
-                with conn.transaction():
-                # BEGIN is executed, a transaction started
-                    cur.execute(
-                        """
-                        INSERT INTO game_definitions (created_on) 
-                        VALUES (CURRENT_TIMESTAMP) RETURNING id, created_on
-                        """
-                    )
-                    game_def = cur.fetchone()
-                    game_def_id = game_def[0]
-                    game_def_created_on = game_def[1]
-                     # for each of the 30 clues from the first step
-                    formatted_clues = []
-                    for clue in thirtyclues:
-                        clue_id = clue[0] 
-                        cur.execute(
-                        """
-                        INSERT INTO game_definition_clues(game_definition_id, clue_id) 
-                        VALUES (%s, %s)
-                        """,
-                        [game_def_id, clue_id],
-                        )
-
-                        pretty_clue = {
-                            "id": clue[3],
-                            "question": clue[4],
-                            "answer": clue[5],
-                            "value": clue[6],
-                            "invalid_count": clue[7],
-                            "canon": clue[8],
-                            "category": {
-                                "id": clue[0],
-                                "title": clue[1],
-                                "canon": clue[2]
-                            }
-                        }
-                        formatted_clues.append(pretty_clue)
-                        print("FORMATTED CLUES!", formatted_clues)
-
-                    return {
-                        "id": game_def_id,
-                        "created_on": game_def_created_on, 
-                        "clues": formatted_clues,
-                    }
-
-                            
-
-                             #the id value for each one with the new id from the last step"
-                         #into game_definiteion_clues
-                #         """
-                #         SELECT 
-                #         """
-                #     )
-                    # These two operation run atomically in the same transaction
-
-                    # COMMIT is executed at the end of the block.
-                    # The connection is in idle state again.
-
-                    #   The connection is closed at the end of the block.
-
-
-
-
-            #     for clue in thirtyclues:
-
-            # except psycopg.errors.UniqueViolation:
-            #     # status values at https://github.com/encode/starlette/blob/master/starlette/status.py
-            #     response.status_code = status.HTTP_409_CONFLICT
-            #     return {
-            #         "message": "Could not create duplicate category",
-            #     }
-            # row = cur.fetchone()
-            # record = {}
-            # for i, column in enumerate(cur.description):
-            #     record[column.name] = row[i]
-            # return record
+def create_custom_game(conn=Depends(get_conn)):
+    # Boards are made ahead of time, see game_pool.py
+    claimed = game_pool.games.claim(conn)
+    if claimed is not None:
+        game_def_id, game_def_created_on, clues = claimed
+    else:
+        # The pool is empty, make one now
+        clues = game_pool.pick_clues(conn)
+        game_def_id, game_def_created_on = game_pool.create_game(conn, clues)
+
+    formatted_clues = [clue_record(clue) for clue in clues]
+
+    # Encodes the response directly, see rows.py
+    return json_response({
+        "id": game_def_id,
+        "created_on": game_def_created_on, 
+        "clues": formatted_clues,
+    })
@@ -0,0 +1,73 @@
+from fastapi import APIRouter, Response, status
+from fastapi.responses import PlainTextResponse
+import pymongo
+import board_store
+import category_sync
+import db
+import game_pool
+import invalidations
+import metrics
+from cache import cache
+from ratelimit import limiter
+from singleflight import flights
+from counts import counts
+
+
+router = APIRouter()
+
+
+# Reports the state of the database connection pools, for example how many
+# requests are waiting for a connection and how long they waited.
+# Mongo is pinged so the probe fails when the server can't be reached.
+@router.get("/api/health")
+def health(response: Response):
+    mongo = db.mongo_stats()
+    sync = category_sync.sync.stats()
+    try:
+        with db.connection() as conn:
+            sync.update(category_sync.pending(conn))
+    except Exception:
+        # the health check still answers when PostgreSQL is down
+        pass
+    try:
+        db.mongo_client.admin.command("ping")
+        mongo["ok"] = True
+    except pymongo.errors.PyMongoError:
+        mongo["ok"] = False
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {
+        "mode": db.API_MODE,
+        "postgres": db.pool_stats(),
+        "postgres_async": db.async_pool_stats(),
+        "mongo": mongo,
+        "cache": cache.stats(),
+        "counts": counts.stats(),
+        "invalidations": invalidations.buffer.stats(),
+        "game_pool": game_pool.games.stats(),
+        "category_sync": sync,
+        "boards": board_store.store.stats(),
+        "rate_limit": limiter.stats(),
+        "single_flight": flights.stats(),
+    }
+
+
+# The timings from metrics.py in the Prometheus text format, plus the
+# numbers from the pools and the cache
+@router.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    gauges = {
+        "trivia_pg_pool": db.pool_stats(),
+        "trivia_pg_async_pool": db.async_pool_stats(),
+        "trivia_mongo_pool": db.mongo_stats(),
+        "trivia_cache": cache.stats(),
+        "trivia_counts": counts.stats(),
+        "trivia_game_pool": game_pool.games.stats(),
+        "trivia_category_sync": category_sync.sync.stats(),
+        "trivia_boards": board_store.store.stats(),
+        "trivia_rate_limit": limiter.stats(),
+        "trivia_single_flight": flights.stats(),
+    }
+    return PlainTextResponse(
+        metrics.render(gauges),
+        media_type="text/plain; version=0.0.4",
+    )
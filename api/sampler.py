@@ -0,0 +1,221 @@
+import os
+import random
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+
+# Picking random clues with ORDER BY RANDOM() makes PostgreSQL sort the
+# whole clues table on every request. Instead, each ClueSampler keeps the
+# ids of the clues it may pick in memory, picks ids at random from that
+# list and then loads just those clues by primary key.
+#
+# The lists are kept up to date in the background: new clues are added by
+# looking for ids above the biggest id seen so far, and the whole list is
+# reloaded from time to time to pick up any other change. Clues that stop
+# matching in between (for example a clue marked invalid) are removed with
+# discard(). The query that loads the picked clues checks the condition
+# again, so a stale id is never returned, it is just picked again.
+
+# The columns every router uses for a clue with its category
+CLUE_COLUMNS = """
+    categories.id, categories.title, categories.canon,
+    clues.id, clues.question, clues.answer,
+    clues.value, clues.invalid_count,
+    clues.canon
+"""
+
+# How many times to pick again when some picked clues no longer match
+MAX_RETRIES = 5
+
+
+class ClueSampler:
+    def __init__(self, where):
+        # SQL condition on the clues table, for example "clues.canon IS true"
+        self.where = where
+        # array of 64 bit ints, a lot smaller than a list of Python ints.
+        # Always sorted, reload reads them in order and add_new only adds
+        # bigger ones.
+        self.ids = array("q")
+        # ids in self.ids that no longer match
+        self.discarded = set()
+        self.max_id = 0
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def reload(self, conn):
+        ids = array("q")
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT clues.id
+                FROM clues
+                WHERE {self.where}
+                ORDER BY clues.id
+            """
+            )
+            while True:
+                rows = cur.fetchmany(10000)
+                if not rows:
+                    break
+                ids.extend(row[0] for row in rows)
+        with self.lock:
+            self.ids = ids
+            self.discarded = set()
+            self.max_id = ids[-1] if ids else 0
+            self.loaded = True
+
+    def add_new(self, conn):
+        # Adds the clues created since the last reload or add_new
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT clues.id
+                FROM clues
+                WHERE clues.id > %s AND {self.where}
+                ORDER BY clues.id
+            """,
+                [self.max_id],
+            )
+            new_ids = [row[0] for row in cur.fetchall()]
+        if new_ids:
+            with self.lock:
+                self.ids.extend(new_ids)
+                self.max_id = max(self.max_id, new_ids[-1])
+
+    def discard(self, clue_id):
+        with self.lock:
+            # Only ids that are in the list, pick counts the usable ones as
+            # len(ids) - len(discarded). Routes discard clues that were
+            # never in it (a clue marked invalid again) and ids picked
+            # before a reload may not be in the new list.
+            i = bisect_left(self.ids, clue_id)
+            if i < len(self.ids) and self.ids[i] == clue_id:
+                self.discarded.add(clue_id)
+
+    def pick(self, n, exclude=()):
+        # Returns up to n distinct random ids
+        with self.lock:
+            ids = self.ids
+            discarded = self.discarded
+            available = len(ids) - len(discarded)
+            if available <= 0:
+                return []
+            n = min(n, available)
+            picked = set()
+            # Picking random positions and skipping the ones we can't use
+            # takes about n tries as long as most ids are still usable
+            tries = 0
+            while len(picked) < n and tries < n * 20:
+                tries += 1
+                clue_id = ids[random.randrange(len(ids))]
+                if clue_id in discarded or clue_id in exclude:
+                    continue
+                picked.add(clue_id)
+            return list(picked)
+
+    def fetch(self, conn, n):
+        # Returns the rows of n distinct random clues (fewer if there are
+        # not enough), in the CLUE_COLUMNS order, or None if the sampler
+        # has not been loaded yet
+        if not self.loaded:
+            return None
+        rows = []
+        seen = set()
+        with conn.cursor() as cur:
+            for _ in range(MAX_RETRIES):
+                picked = self.pick(n - len(rows), exclude=seen)
+                if not picked:
+                    break
+                cur.execute(self._select_sql(), [picked])
+                rows.extend(self._check_found(picked, cur.fetchall(), seen))
+                if len(rows) >= n:
+                    break
+        # The database returns rows in id order, shuffle them back
+        random.shuffle(rows)
+        return rows
+
+    async def fetch_async(self, conn, n):
+        # The same as fetch with an async connection
+        if not self.loaded:
+            return None
+        rows = []
+        seen = set()
+        async with conn.cursor() as cur:
+            for _ in range(MAX_RETRIES):
+                picked = self.pick(n - len(rows), exclude=seen)
+                if not picked:
+                    break
+                await cur.execute(self._select_sql(), [picked])
+                found = await cur.fetchall()
+                rows.extend(self._check_found(picked, found, seen))
+                if len(rows) >= n:
+                    break
+        random.shuffle(rows)
+        return rows
+
+    def _select_sql(self):
+        return f"""
+            SELECT {CLUE_COLUMNS}
+            FROM categories
+                INNER JOIN clues
+                ON (clues.category_id = categories.id)
+            WHERE clues.id = ANY(%s) AND {self.where}
+        """
+
+    def _check_found(self, picked, found, seen):
+        seen.update(picked)
+        # Whatever did not come back no longer matches
+        for clue_id in set(picked) - {row[3] for row in found}:
+            self.discard(clue_id)
+        return found
+
+
+valid_clues = ClueSampler("clues.invalid_count = 0")
+all_clues = ClueSampler("true")
+canon_clues = ClueSampler("clues.canon IS true")
+
+samplers = [valid_clues, all_clues, canon_clues]
+
+
+_refresher = None
+_refresher_stop = threading.Event()
+
+
+def start(pool):
+    # Loads the samplers and keeps them fresh in a background thread
+    global _refresher
+    _refresher_stop.clear()
+    _refresher = threading.Thread(target=_refresh, args=(pool,), daemon=True)
+    _refresher.start()
+
+
+def stop():
+    global _refresher
+    _refresher_stop.set()
+    if _refresher is not None:
+        _refresher.join()
+        _refresher = None
+
+
+def _refresh(pool):
+    interval = float(os.environ.get("SAMPLER_REFRESH_INTERVAL", 30))
+    reload_interval = float(os.environ.get("SAMPLER_RELOAD_INTERVAL", 3600))
+    last_reload = None
+    while True:
+        try:
+            with pool.connection() as conn:
+                now = time.monotonic()
+                if last_reload is None or now - last_reload > reload_interval:
+                    for sampler in samplers:
+                        sampler.reload(conn)
+                    last_reload = now
+                else:
+                    for sampler in samplers:
+                        sampler.add_new(conn)
+        except Exception:
+            # the database may be down, try again on the next round
+            pass
+        if _refresher_stop.wait(interval):
+            return
@@ -0,0 +1,325 @@
+# Database changes this API needs on top of the jservice data.
+#
+# Each migration runs once, in order, and is recorded by name in the
+# schema_migrations table. They run when the server starts (see main.py),
+# so never edit a migration that has been released, add a new one instead.
+#
+# The Mongo indexes are in MONGO_INDEXES, and are created at startup too.
+#
+# Run them by hand from the api directory with
+#   python -m schema
+import os
+
+# Lets only one server process run migrations at a time
+LOCK_ID = 7216001
+
+# Every server process runs the migrations and creates the Mongo indexes
+# when it starts. gunicorn.conf.py runs them once before starting its
+# workers and turns this off, so the workers don't queue up on the lock.
+MIGRATE_ON_STARTUP = os.environ.get("MIGRATE_ON_STARTUP", "true") == "true"
+
+
+MIGRATIONS = [
+    (
+        "001_game_totals",
+        # Total value of the clues of each game, kept up to date by a
+        # trigger on clues so get_game does not have to add them up on
+        # every request
+        """
+        CREATE TABLE game_totals (
+            game_id INTEGER PRIMARY KEY
+                REFERENCES games (id) ON DELETE CASCADE,
+            total_amount_won BIGINT NOT NULL DEFAULT 0
+        );
+
+        INSERT INTO game_totals (game_id, total_amount_won)
+        SELECT clues.game_id, SUM(clues.value)
+        FROM clues
+        WHERE clues.game_id IS NOT NULL AND clues.value IS NOT NULL
+        GROUP BY clues.game_id;
+
+        CREATE FUNCTION game_totals_on_clue_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE')
+                AND OLD.game_id IS NOT NULL AND OLD.value IS NOT NULL
+            THEN
+                UPDATE game_totals
+                SET total_amount_won = total_amount_won - OLD.value
+                WHERE game_id = OLD.game_id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE')
+                AND NEW.game_id IS NOT NULL AND NEW.value IS NOT NULL
+            THEN
+                INSERT INTO game_totals (game_id, total_amount_won)
+                VALUES (NEW.game_id, NEW.value)
+                ON CONFLICT (game_id) DO UPDATE
+                SET total_amount_won =
+                    game_totals.total_amount_won + EXCLUDED.total_amount_won;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER game_totals_on_clue_change
+        AFTER INSERT OR DELETE OR UPDATE OF value, game_id ON clues
+        FOR EACH ROW EXECUTE FUNCTION game_totals_on_clue_change();
+        """,
+    ),
+    (
+        "002_clue_search",
+        # Full text search over clues for /api/clues/search. The search
+        # column is computed by PostgreSQL from the question and answer,
+        # words in the question count more than words in the answer.
+        # The trigram index is for fuzzy matching of answers.
+        """
+        ALTER TABLE clues ADD COLUMN search tsvector
+            GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', coalesce(question, '')), 'A')
+                || setweight(to_tsvector('english', coalesce(answer, '')), 'B')
+            ) STORED;
+
+        CREATE INDEX clues_search_idx ON clues USING GIN (search);
+
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+        CREATE INDEX clues_answer_trgm_idx
+            ON clues USING GIN (answer gin_trgm_ops);
+        """,
+    ),
+    (
+        "003_game_pool",
+        # Boards made ahead of time for POST /api/custom-games wait in
+        # game_definitions with pooled set until a request claims one, see
+        # game_pool.py. The position keeps the clues of a board in order.
+        """
+        ALTER TABLE game_definitions
+            ADD COLUMN pooled BOOLEAN NOT NULL DEFAULT false;
+
+        CREATE INDEX game_definitions_pooled_idx
+            ON game_definitions (id) WHERE pooled;
+
+        ALTER TABLE game_definition_clues ADD COLUMN position INTEGER;
+        """,
+    ),
+    (
+        "004_category_changes",
+        # Every change to categories is written down here, in the same
+        # transaction, and copied to Mongo by category_sync.py
+        """
+        CREATE TABLE category_changes (
+            id BIGSERIAL PRIMARY KEY,
+            category_id INTEGER NOT NULL,
+            changed_on TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+        );
+
+        CREATE FUNCTION category_changes_on_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                INSERT INTO category_changes (category_id) VALUES (OLD.id);
+            ELSE
+                INSERT INTO category_changes (category_id) VALUES (NEW.id);
+            END IF;
+            -- the same notification is only sent once per transaction
+            PERFORM pg_notify('category_changes', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER category_changes_on_change
+        AFTER INSERT OR DELETE OR UPDATE ON categories
+        FOR EACH ROW EXECUTE FUNCTION category_changes_on_change();
+        """,
+    ),
+    (
+        "005_indexes",
+        # Indexes for the columns the routes filter, join and sort on.
+        # python -m explain checks that the queries really use them.
+        # IF NOT EXISTS because a copy of the data may already have some.
+        """
+        -- the clues of a category, and one clue per value for game boards
+        CREATE INDEX IF NOT EXISTS clues_category_id_value_idx
+            ON clues (category_id, value);
+
+        -- the clues of a game, for the game_totals trigger
+        CREATE INDEX IF NOT EXISTS clues_game_id_idx
+            ON clues (game_id);
+
+        -- the ids the random clue samplers load (see sampler.py), these
+        -- conditions must match the samplers' exactly to be used
+        CREATE INDEX IF NOT EXISTS clues_valid_id_idx
+            ON clues (id) WHERE invalid_count = 0;
+
+        CREATE INDEX IF NOT EXISTS clues_canon_id_idx
+            ON clues (id) WHERE canon IS true;
+
+        -- the clues of a custom game, in board order
+        CREATE INDEX IF NOT EXISTS game_definition_clues_game_definition_id_idx
+            ON game_definition_clues (game_definition_id, position);
+
+        -- categories_list pages through categories by (title, id)
+        CREATE INDEX IF NOT EXISTS categories_title_id_idx
+            ON categories (title, id);
+        """,
+    ),
+    (
+        "006_category_boards",
+        # Each category with its valid clues grouped by value, as the JSON
+        # that /api/boards sends, see board_store.py. Triggers mark a board
+        # stale when its category or clues change and board_store.py rebuilds
+        # the stale ones in the background. board is NULL until the first
+        # build.
+        """
+        CREATE TABLE category_boards (
+            category_id INTEGER PRIMARY KEY
+                REFERENCES categories (id) ON DELETE CASCADE,
+            board JSONB,
+            -- has clues for at least BOARD_VALUES different values
+            playable BOOLEAN NOT NULL DEFAULT false,
+            stale BOOLEAN NOT NULL DEFAULT true,
+            refreshed_on TIMESTAMPTZ
+        );
+
+        CREATE INDEX category_boards_playable_idx
+            ON category_boards (category_id) WHERE playable;
+
+        CREATE INDEX category_boards_stale_idx
+            ON category_boards (category_id) WHERE stale;
+
+        INSERT INTO category_boards (category_id)
+        SELECT id FROM categories;
+
+        CREATE FUNCTION category_boards_on_category_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO category_boards (category_id) VALUES (NEW.id);
+            ELSE
+                UPDATE category_boards SET stale = true
+                WHERE category_id = NEW.id AND NOT stale;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER category_boards_on_category_change
+        AFTER INSERT OR UPDATE OF title, canon ON categories
+        FOR EACH ROW EXECUTE FUNCTION category_boards_on_category_change();
+
+        CREATE FUNCTION category_boards_on_clue_change() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE category_boards SET stale = true
+                WHERE category_id = OLD.category_id AND NOT stale;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                UPDATE category_boards SET stale = true
+                WHERE category_id = NEW.category_id AND NOT stale;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER category_boards_on_clue_change
+        AFTER INSERT OR DELETE OR UPDATE OF
+            question, answer, value, invalid_count, canon, category_id
+        ON clues
+        FOR EACH ROW EXECUTE FUNCTION category_boards_on_clue_change();
+        """,
+    ),
+    (
+        "007_updated_at",
+        # When each row last changed, for the ETag and Last-Modified
+        # headers of the detail routes (see conditional.py). now() as the
+        # default for the rows already there means the tables are not
+        # rewritten.
+        """
+        CREATE FUNCTION set_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at = clock_timestamp();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        ALTER TABLE categories
+            ADD COLUMN updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+        ALTER TABLE clues
+            ADD COLUMN updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+        ALTER TABLE games
+            ADD COLUMN updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+        ALTER TABLE game_totals
+            ADD COLUMN updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+        CREATE TRIGGER categories_set_updated_at
+        BEFORE UPDATE ON categories
+        FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+
+        CREATE TRIGGER clues_set_updated_at
+        BEFORE UPDATE ON clues
+        FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+
+        CREATE TRIGGER games_set_updated_at
+        BEFORE UPDATE ON games
+        FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+
+        CREATE TRIGGER game_totals_set_updated_at
+        BEFORE UPDATE ON game_totals
+        FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+        """,
+    ),
+]
+
+# Indexes of the Mongo collections, as (collection, keys) for create_index.
+# create_index does nothing if the index already exists.
+MONGO_INDEXES = [
+    # categories_list counts the clues of each category by category_id,
+    # without this index every count scans the whole clues collection
+    ("clues", [("category_id", 1)]),
+    # categories_list pages through categories in (title, _id) order
+    ("categories", [("title", 1), ("_id", 1)]),
+]
+
+
+def migrate(conn):
+    with conn.transaction():
+        with conn.cursor() as cur:
+            # Waits here while another process is migrating
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", [LOCK_ID])
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    name TEXT PRIMARY KEY,
+                    applied_on TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+            """
+            )
+            cur.execute("SELECT name FROM schema_migrations")
+            applied = {row[0] for row in cur.fetchall()}
+            for name, sql in MIGRATIONS:
+                if name in applied:
+                    continue
+                cur.execute(sql)
+                cur.execute(
+                    "INSERT INTO schema_migrations (name) VALUES (%s)",
+                    [name],
+                )
+
+
+def create_mongo_indexes(mongo_db):
+    for name, keys in MONGO_INDEXES:
+        mongo_db[name].create_index(keys)
+
+
+def migrate_all():
+    # The migrations and the Mongo indexes, with connections of their own
+    # that are closed again afterwards
+    import psycopg
+    import pymongo
+    import db
+
+    with psycopg.connect() as conn:
+        migrate(conn)
+    with pymongo.MongoClient(db._mongo_url()) as mongo_client:
+        create_mongo_indexes(mongo_client[os.environ["MONGODATABASE"]])
+
+
+if __name__ == "__main__":
+    migrate_all()
@@ -0,0 +1,131 @@
+import asyncio
+import threading
+
+
+# Single-flight loading. When a popular clue is not cached, every request
+# for it that arrives before the first one has filled the cache would run
+# the same query. Instead the first request runs it and the others wait
+# for its answer:
+#
+#   key = cache.key("clue", clue_id)
+#   record = flights.do(key, lambda: load_clue(clue_id), lambda record: cache.set(key, record))
+#
+# Only requests that overlap share a load, the next one after it finished
+# goes to the cache (or loads again). An exception is raised in every
+# request that was waiting for it.
+#
+# A load that started before a write may have read the old row. The
+# routes that write call flights.forget(key) before deleting the cached
+# copy: requests after that start a load of their own instead of waiting
+# for the old one, and the old load's answer is not stored in the cache
+# (it still goes to the requests that were already waiting, which asked
+# before the write). A write that clears a whole namespace (see cache.py)
+# needs no forget, the requests after it use a new key.
+#
+# The sync routes wait on a threading.Event, the async routes on the task
+# of the first request. The two don't share loads.
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # set by forget()
+        self.forgotten = False
+        # the load of an async call
+        self.task = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.tasks = {}
+        self.loads = 0
+        self.shared = 0
+        self.forgotten = 0
+
+    def do(self, key, load, store=None):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = _Call()
+                self.loads += 1
+                first = True
+            else:
+                self.shared += 1
+                first = False
+        if not first:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = load()
+            self._store(call, store, call.result)
+            return call.result
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+            call.done.set()
+
+    async def do_async(self, key, load, store=None):
+        # load is an async function, store a plain one
+        with self.lock:
+            call = self.tasks.get(key)
+            if call is None:
+                call = self.tasks[key] = _Call()
+                self.loads += 1
+            else:
+                self.shared += 1
+        if call.task is None:
+            call.task = asyncio.ensure_future(self._load_async(key, call, load, store))
+        # shield, so the load goes on for the others when the request that
+        # started it is cancelled (the client went away)
+        return await asyncio.shield(call.task)
+
+    async def _load_async(self, key, call, load, store):
+        try:
+            result = await load()
+            self._store(call, store, result)
+            return result
+        finally:
+            with self.lock:
+                if self.tasks.get(key) is call:
+                    del self.tasks[key]
+
+    def _store(self, call, store, result):
+        # None is a row that was not found, there is nothing to store
+        if store is None or result is None:
+            return
+        # Under the lock, so forget() either comes first and the answer is
+        # not stored, or comes after and its cache delete removes it
+        with self.lock:
+            if not call.forgotten:
+                store(result)
+
+    def forget(self, key):
+        # Call before deleting the cached copy of key after a write
+        with self.lock:
+            for calls in (self.calls, self.tasks):
+                call = calls.pop(key, None)
+                if call is not None:
+                    call.forgotten = True
+                    self.forgotten += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "loads": self.loads,
+                "shared": self.shared,
+                "forgotten": self.forgotten,
+                "in_flight": len(self.calls) + len(self.tasks),
+            }
+
+
+flights = SingleFlight()
@@ -0,0 +1,90 @@
+# Pages through /api/clues/search results where many clues have the same
+# rank, which used to repeat or skip the ties at the end of a page.
+#
+# Needs a PostgreSQL server in the PG* environment variables, the tables
+# are temporary and hide the real ones for this connection only. Install
+# requirements-dev.txt and run from the api directory:
+#   python -m pytest tests
+import json
+import psycopg
+import pytest
+from routers.clues import clue_search_page, clue_search_query
+
+# more than two pages, all with the same rank
+TIES = 250
+
+
+@pytest.fixture
+def conn():
+    try:
+        conn = psycopg.connect()
+    except psycopg.OperationalError:
+        pytest.skip("needs PostgreSQL, see the PG* environment variables")
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                CREATE TEMPORARY TABLE categories (
+                    id SERIAL PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    canon BOOLEAN NOT NULL
+                );
+
+                CREATE TEMPORARY TABLE clues (
+                    id SERIAL PRIMARY KEY,
+                    question TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    value INTEGER,
+                    invalid_count INTEGER NOT NULL DEFAULT 0,
+                    canon BOOLEAN NOT NULL,
+                    category_id INTEGER NOT NULL,
+                    search tsvector GENERATED ALWAYS AS (
+                        setweight(to_tsvector('english', coalesce(question, '')), 'A')
+                        || setweight(to_tsvector('english', coalesce(answer, '')), 'B')
+                    ) STORED
+                );
+
+                INSERT INTO categories (title, canon) VALUES ('Rivers', true);
+            """
+            )
+            cur.execute(
+                """
+                INSERT INTO clues (question, answer, value, canon, category_id)
+                SELECT 'This river flows through Cairo', 'the Nile', 200, true, 1
+                FROM generate_series(1, %s)
+            """,
+                [TIES],
+            )
+        yield conn
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def search_all(conn, q, fuzzy):
+    ids = []
+    after = None
+    # one page more than needed, a cursor that does not move would loop
+    for _ in range(TIES // 100 + 2):
+        with conn.cursor() as cur:
+            cur.execute(*clue_search_query(q, fuzzy, after))
+            page = json.loads(clue_search_page(cur.fetchall()).body)
+        ids += [clue["id"] for clue in page["clues"]]
+        after = page["next"]
+        if after is None:
+            return ids
+    pytest.fail("the next cursor never ran out")
+
+
+def test_search_pages_through_ties(conn):
+    ids = search_all(conn, "river cairo", False)
+    assert sorted(ids) == list(range(1, TIES + 1))
+
+
+def test_fuzzy_search_pages_through_ties(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        if cur.fetchone() is None:
+            pytest.skip("needs the pg_trgm extension, see schema.py")
+    ids = search_all(conn, "the nile", True)
+    assert sorted(ids) == list(range(1, TIES + 1))